@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the uploader.
+
+Times link map matching, the file queue model, filtering and sorting it, and
+the upload spool at the sizes big shows throw at it.  No display or Shotgun
+server is needed: Qt is started without a GUI and Shotgun is replaced by a
+fake connection that answers instantly.
+
+This is a plain script rather than pytest benchmarks on purpose.  The uploader
+runs on python 2.5+ with nothing but PyQt4, and comparing runs across versions
+would otherwise mean adding pytest and pytest-benchmark.  Each bench_* case is
+a function of the size that returns the callable to time, the same shape a
+parametrized test would take, so moving them over later is mechanical.
+
+Multipart uploads are timed against a stand-in for S3 style storage that runs
+in process.  It can also be run on its own to point the uploader at:
+
+    python benchmarks.py -s 8000               # DEFAULT_STORAGE_URL = "http://localhost:8000/uploads"
+
+Every run is appended to a JSON results file under a label (the git revision by
+default) so timings can be compared between versions:
+
+    python benchmarks.py                       # run everything
+    python benchmarks.py -l before -k model    # only benchmarks matching 'model'
+    python benchmarks.py -c before             # compare the latest run to 'before'
+"""
+import os
+import re
+import sys
+import time
+import json
+import uuid
+import types
+import shutil
+import urllib
+import socket
+import hashlib
+import tempfile
+import optparse
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+# no display needed.  Qt4 builds ignore this and rely on QApplication(argv, False)
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+################################################################################
+# Fake Shotgun
+################################################################################
+class FakeFault(Exception):
+    pass
+
+class FakeConnection(object):
+    """answers the calls the uploader makes without going over the wire"""
+    def __init__(self):
+        self.calls = 0
+
+    def find_one(self, entity_type, filters, fields=None):
+        self.calls += 1
+        name = '/'.join([str(f[2]) for f in filters])
+        return {'type': entity_type, 'id': self.calls, 'name': name}
+
+    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, retired_only=False, page=0):
+        self.calls += 1
+        return []
+
+# __link_for_file imports the api module itself, so make sure it finds the fake
+fake_sg = types.ModuleType('shotgun_api3_preview')
+fake_sg.Fault = FakeFault
+fake_sg.Shotgun = lambda *args, **kwargs: FakeConnection()
+sys.modules.setdefault('shotgun_api3_preview', fake_sg)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import uploader
+from PyQt4 import QtGui
+from PyQt4 import QtCore
+
+################################################################################
+# Fake Storage
+################################################################################
+class StorageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """the S3 multipart calls the uploader makes, parts and objects kept as files"""
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body='', headers={}):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def split(self):
+        (path, query) = (self.path.split('?', 1) + [''])[:2]
+        return (urllib.unquote(path), dict([(q.split('=', 1) + [''])[:2] for q in query.split('&') if q]))
+
+    def file_for(self, upload_id, number=None):
+        name = number is None and upload_id or '%s.%d' % (upload_id, number)
+        return os.path.join(self.server.directory, name)
+
+    def do_POST(self):
+        (path, query) = self.split()
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = path
+            self.reply(200, '<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>' % upload_id)
+        elif self.server.uploads.get(query.get('uploadId')) == path:
+            upload_id = query['uploadId']
+            out = open(self.file_for(upload_id), 'wb')
+            try:
+                for number in re.findall(r'<PartNumber>(\d+)</PartNumber>', body):
+                    part = self.file_for(upload_id, int(number))
+                    out.write(open(part, 'rb').read())
+                    os.remove(part)
+            finally:
+                out.close()
+            self.server.objects[path] = self.file_for(upload_id)
+            del self.server.uploads[upload_id]
+            self.reply(200, '<CompleteMultipartUploadResult><Key>%s</Key></CompleteMultipartUploadResult>' % path)
+        else:
+            self.reply(404, '<Error><Code>NoSuchUpload</Code></Error>')
+
+    def do_PUT(self):
+        (path, query) = self.split()
+        length = int(self.headers.get('content-length', 0))
+        md5 = hashlib.md5()
+        out = None
+        if self.server.uploads.get(query.get('uploadId')) == path:
+            out = open(self.file_for(query['uploadId'], int(query['partNumber'])), 'wb')
+        try:
+            while length:
+                data = self.rfile.read(min(length, 1024 * 1024))
+                if not data:
+                    break
+                length -= len(data)
+                md5.update(data)
+                if out is not None:
+                    out.write(data)
+        finally:
+            if out is not None:
+                out.close()
+        if out is None:
+            self.reply(404, '<Error><Code>NoSuchUpload</Code></Error>')
+            return
+        self.server.lock.acquire()
+        self.server.puts += 1
+        fail = self.server.fail_every and self.server.puts % self.server.fail_every == 0
+        self.server.lock.release()
+        if fail:
+            # for the retries to deal with
+            self.reply(500, '<Error><Code>InternalError</Code></Error>')
+        else:
+            self.reply(200, headers={'ETag': '"%s"' % md5.hexdigest()})
+
+    def do_DELETE(self):
+        (path, query) = self.split()
+        self.server.uploads.pop(query.get('uploadId'), None)
+        self.reply(204)
+
+    def log_message(self, format, *args):
+        pass
+
+class StorageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, fail_every=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), StorageHandler)
+        self.directory = tempfile.mkdtemp(prefix='uploader_storage_')
+        # upload id -> object path, and object path -> file once assembled
+        self.uploads = {}
+        self.objects = {}
+        # every fail_every'th part put fails
+        self.fail_every = fail_every
+        self.puts = 0
+        self.lock = threading.Lock()
+
+    def url(self):
+        return 'http://127.0.0.1:%d/uploads' % self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        shutil.rmtree(self.directory, True)
+
+################################################################################
+# Fixtures
+################################################################################
+EXTENSIONS = ['.exr', '.jpg', '.mov', '.tif', '.txt']
+
+def synthetic_paths(n):
+    """paths in the layout DEFAULT_LINK_MAP expects, with some that match nothing"""
+    paths = []
+    for i in xrange(n):
+        ext = EXTENSIONS[i % len(EXTENSIONS)]
+        kind = i % 3
+        if kind == 0:
+            paths.append('/job_root/show%d/assets/prop/thing%d/thing%d%s' % (i % 7, i % 500, i, ext))
+        elif kind == 1:
+            paths.append('/job_root/show%d/shots/%03d/comp/shot%d%s' % (i % 7, i % 900, i, ext))
+        else:
+            paths.append('/home/someone/scratch/%d/render%d%s' % (i % 40, i, ext))
+    return paths
+
+def synthetic_files(n):
+    """ShotgunFile objects built without touching the filesystem"""
+    files = []
+    link = {'type': 'Shot', 'id': 1, 'name': '010'}
+    for (i, path) in enumerate(synthetic_paths(n)):
+        f = uploader.ShotgunFile.__new__(uploader.ShotgunFile)
+        f.path = path
+        f.upload_path = path
+        f.tags = uploader.DEFAULT_TAGS
+        f.hero_offset = path.endswith('.mov') and '1' or ''
+        f.link = link
+        f.note = ''
+        f.link_name = link['name']
+        f.size = 1024 * (i % 4096)
+        files.append(f)
+    return files
+
+class FakePrefs(object):
+    link_map = uploader.DEFAULT_LINK_MAP
+
+class FakeUploader(object):
+    """just enough of an Uploader for the link map code to run against"""
+    def __init__(self):
+        self.prefs = FakePrefs()
+        self._Uploader__conn = FakeConnection()
+        self._Uploader__PATTERN_RE = uploader.Uploader._Uploader__PATTERN_RE
+
+    def tr(self, text):
+        return text
+
+def new_model(files=None):
+    stack = QtGui.QUndoStack()
+    model = uploader.ShotgunFileModel(stack)
+    if files:
+        model.append_files(files)
+    return (stack, model)
+
+################################################################################
+# Benchmarks
+#   Each benchmark takes the number of rows and returns a function to time.
+#   Setup happens outside the returned function so it isn't counted.
+################################################################################
+def bench_link_map(n):
+    link_for_file = uploader.Uploader._Uploader__link_for_file.im_func
+    fake = FakeUploader()
+    paths = synthetic_paths(n)
+    def run():
+        for path in paths:
+            link_for_file(fake, path)
+    return run
+
+def bench_model_insert(n):
+    (stack, model) = new_model()
+    files = synthetic_files(n)
+    def run():
+        stack.push(uploader.NewFileCommand(model, files))
+    return run
+
+def bench_model_edit(n):
+    # edits are one at a time from the ui, time a fixed number of them
+    (stack, model) = new_model(synthetic_files(n))
+    edits = min(n, 1000)
+    step = max(1, n / edits)
+    indexes = [model.index(row, 3) for row in xrange(0, n, step)][:edits]
+    value = QtCore.QVariant('benchmark')
+    def run():
+        for index in indexes:
+            model.setData(index, value, QtCore.Qt.EditRole)
+    return run
+
+def bench_model_bulk_edit(n):
+    # every row retagged as one command
+    (stack, model) = new_model(synthetic_files(n))
+    rows = range(n)
+    column = model.column_for('tags')
+    def run():
+        stack.push(uploader.BulkEditCommand(model, rows, column, '$value,benchmark'))
+    return run
+
+def bench_model_delete(n):
+    # delete every other row, the worst case for row by row deletes
+    (stack, model) = new_model(synthetic_files(n))
+    rows = range(0, n, 2)
+    def run():
+        stack.push(uploader.DeleteFilesCommand(model, rows))
+    return run
+
+def bench_model_undo(n):
+    (stack, model) = new_model(synthetic_files(n))
+    stack.push(uploader.DeleteFilesCommand(model, range(0, n, 2)))
+    def run():
+        stack.undo()
+    return run
+
+def bench_drop(n):
+    # only until the drop returns, batches are handed out from the event loop
+    (stack, model) = new_model()
+    # grouping sequences, the slower way a drop goes
+    model.feeder.sequences = True
+    data = QtCore.QMimeData()
+    uris = ['file://' + urllib.pathname2url(path) for path in synthetic_paths(n)]
+    data.setData('text/uri-list', QtCore.QByteArray('\r\n'.join(uris) + '\r\n'))
+    def run():
+        model.dropMimeData(data, QtCore.Qt.CopyAction, -1, -1, QtCore.QModelIndex())
+    return run
+
+def new_filter(n):
+    (stack, model) = new_model(synthetic_files(n))
+    proxy = uploader.FileFilterModel()
+    proxy.setSourceModel(model)
+    return (stack, model, proxy)
+
+def bench_filter_typing(n):
+    # a keystroke at a time, the way the filter box sees it
+    (stack, model, proxy) = new_filter(n)
+    text = 'show3/shots'
+    def run():
+        for i in xrange(1, len(text) + 1):
+            proxy.set_filter(text[:i])
+    return run
+
+def bench_filter_type(n):
+    (stack, model, proxy) = new_filter(n)
+    def run():
+        proxy.set_filter('type:video size>1M')
+    return run
+
+def bench_sort(n):
+    (stack, model, proxy) = new_filter(n)
+    column = model.column_for('display_path')
+    def run():
+        proxy.sort(column)
+    return run
+
+def md5_of(path):
+    md5 = hashlib.md5()
+    fh = open(path, 'rb')
+    try:
+        for data in iter(lambda: fh.read(1024 * 1024), ''):
+            md5.update(data)
+    finally:
+        fh.close()
+    return md5.hexdigest()
+
+def multipart_bench(workers):
+    # n is megabytes here, every 7th part fails once so retries get timed too
+    def bench(n):
+        (fd, path) = tempfile.mkstemp(prefix='uploader_bench_')
+        for i in xrange(n):
+            os.write(fd, os.urandom(1024 * 1024))
+        os.close(fd)
+        server = StorageServer(fail_every=7)
+        threading.Thread(target=server.serve_forever).start()
+        uploader_ = uploader.MultipartUploader(server.url(), 8 * 1024 * 1024, workers, retries=3)
+        def run():
+            try:
+                url = uploader_.upload(path)
+                key = urllib.unquote(url.split(str(server.server_address[1]), 1)[1])
+                assert md5_of(server.objects[key]) == md5_of(path), 'assembled object differs'
+            finally:
+                uploader_.pool.close()
+                server.close()
+                os.remove(path)
+        return run
+    return bench
+
+def drain_spool(directory):
+    """claim and complete jobs until there are none left, returning the ids"""
+    spool = uploader.Spool(directory)
+    ids = []
+    try:
+        while True:
+            job = spool.claim(uploader.worker_name())
+            if job is None:
+                return ids
+            spool.complete(job[0], uploader.worker_name(), 0, 0.0)
+            ids.append(job[0])
+    finally:
+        spool.close()
+
+def bench_spool(n):
+    # four processes racing for the same jobs, every job must be claimed once
+    directory = tempfile.mkdtemp(prefix='uploader_spool_')
+    spool = uploader.Spool(directory)
+    spool.enqueue([{'file': f.to_dict(), 'default_link': None} for f in synthetic_files(n)])
+    spool.close()
+    def run():
+        try:
+            pool = uploader.multiprocessing.Pool(4)
+            ids = sum(pool.map(drain_spool, [directory] * 4), [])
+            pool.close()
+            pool.join()
+            assert len(ids) == len(set(ids)) == n, 'jobs claimed more than once or lost'
+        finally:
+            shutil.rmtree(directory, True)
+    return run
+
+BENCHMARKS = [
+    ('link_map', bench_link_map, [100000]),
+    ('model_insert', bench_model_insert, [1000, 10000, 100000]),
+    ('model_edit', bench_model_edit, [1000, 10000, 100000]),
+    ('model_bulk_edit', bench_model_bulk_edit, [1000, 10000, 100000]),
+    ('model_delete', bench_model_delete, [1000, 10000, 100000]),
+    ('model_undo', bench_model_undo, [1000, 10000, 100000]),
+    ('drop', bench_drop, [1000, 10000, 100000]),
+    ('filter_typing', bench_filter_typing, [1000, 10000, 100000]),
+    ('filter_type', bench_filter_type, [1000, 10000, 100000]),
+    ('sort', bench_sort, [1000, 10000, 100000]),
+    ('spool', bench_spool, [1000, 10000]),
+    ('multipart_1', multipart_bench(1), [64, 256]),
+    ('multipart_8', multipart_bench(8), [64, 256]),
+]
+
+################################################################################
+# Running and recording
+################################################################################
+def git_label():
+    """label runs with the current revision when nothing else was given"""
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        rev = proc.communicate()[0].strip()
+        if proc.returncode == 0 and rev:
+            return rev
+    except OSError:
+        pass
+    return 'unlabeled'
+
+def run_benchmarks(keyword, repeat, max_rows):
+    """run matching benchmarks, keeping the best of repeat runs for each"""
+    results = {}
+    for (name, bench, sizes) in BENCHMARKS:
+        if keyword and keyword not in name:
+            continue
+        for n in sizes:
+            if max_rows and n > max_rows:
+                continue
+            key = '%s[%d]' % (name, n)
+            best = None
+            for i in xrange(repeat):
+                # fresh setup each time, these all mutate their fixtures
+                run = bench(n)
+                start = time.time()
+                run()
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            results[key] = best
+            print '%-24s %10.4fs' % (key, best)
+            sys.stdout.flush()
+    return results
+
+def load_runs(path):
+    if not os.path.exists(path):
+        return []
+    fh = open(path)
+    try:
+        return json.load(fh)['runs']
+    finally:
+        fh.close()
+
+def save_run(path, label, results):
+    runs = load_runs(path)
+    runs.append({
+        'label': label,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'qt': QtCore.QT_VERSION_STR,
+        'results': results,
+    })
+    fh = open(path, 'w')
+    try:
+        json.dump({'runs': runs}, fh, indent=2, sort_keys=True)
+    finally:
+        fh.close()
+
+def compare(path, baseline, threshold):
+    """print the latest run against the latest run labeled baseline"""
+    runs = load_runs(path)
+    if not runs:
+        print 'no results in %s' % path
+        return 1
+    base = [r for r in runs if r['label'] == baseline]
+    if not base:
+        print "no run labeled '%s' in %s" % (baseline, path)
+        return 1
+    (base, latest) = (base[-1], runs[-1])
+    print '%-24s %10s %10s %8s' % ('benchmark', base['label'], latest['label'], 'ratio')
+    regressions = 0
+    for key in sorted(latest['results'].keys()):
+        if key not in base['results']:
+            continue
+        (old, new) = (base['results'][key], latest['results'][key])
+        ratio = old and new / old or 0.0
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = '  SLOWER'
+            regressions += 1
+        elif ratio and ratio < 1.0 - threshold:
+            flag = '  faster'
+        print '%-24s %9.4fs %9.4fs %7.2fx%s' % (key, old, new, ratio, flag)
+    return regressions and 2 or 0
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-k', dest='keyword', default='', help='only run benchmarks whose name contains KEYWORD')
+    parser.add_option('-r', dest='repeat', type='int', default=3, help='runs per benchmark, the best is kept [%default]')
+    parser.add_option('-n', dest='max_rows', type='int', default=0, help='skip sizes above MAX_ROWS')
+    parser.add_option('-l', dest='label', default=None, help='label to record the run under [git revision]')
+    parser.add_option('-o', dest='output', default='benchmarks.json', help='results file [%default]')
+    parser.add_option('-c', dest='compare', default=None, metavar='LABEL', help='compare the latest run to LABEL and exit')
+    parser.add_option('-t', dest='threshold', type='float', default=0.1, help='ratio change reported as a regression [%default]')
+    parser.add_option('-s', dest='storage', type='int', default=0, metavar='PORT', help='serve fake storage on PORT until interrupted')
+    (options, args) = parser.parse_args()
+    if options.storage:
+        server = StorageServer(options.storage)
+        print 'storage at %s, objects in %s' % (server.url(), server.directory)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if options.compare:
+        sys.exit(compare(options.output, options.compare, options.threshold))
+    # no gui, nothing here needs a display
+    app = QtGui.QApplication(sys.argv, False)
+    results = run_benchmarks(options.keyword, options.repeat, options.max_rows)
+    save_run(options.output, options.label or git_label(), results)
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+"""
+Unit tests for the parts of the uploader that don't need a window or Shotgun.
+
+    python test_uploader.py
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import httplib
+import unittest
+import threading
+import xmlrpclib
+import StringIO
+
+import uploader
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class ThroughputEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def send(self, estimate, size, seconds):
+        estimate.start_file(size)
+        self.clock.now += seconds
+        estimate.transferred(size, seconds)
+        estimate.file_done(0.0)
+
+    def test_empty_first_file(self):
+        estimate = uploader.ThroughputEstimator(1000, 2, clock=self.clock)
+        self.send(estimate, 0, 0.5)
+        self.assertEqual(estimate.remaining(), None)
+        self.assertEqual(estimate.status(), 'working out the rate...')
+        # the next real file sets the rate
+        self.send(estimate, 1000, 2.0)
+        self.assertEqual(estimate.rate, 500.0)
+
+    def test_empty_file_leaves_rate(self):
+        estimate = uploader.ThroughputEstimator(2000, 3, clock=self.clock)
+        self.send(estimate, 1000, 2.0)
+        self.send(estimate, 0, 1.0)
+        self.assertEqual(estimate.rate, 500.0)
+        self.assertTrue(estimate.status().endswith('left'))
+
+    def test_zero_rate(self):
+        estimate = uploader.ThroughputEstimator(1000, 1, clock=self.clock)
+        estimate.rate = 0.0
+        self.assertEqual(estimate.status(), 'working out the rate...')
+
+class OneShotServer(threading.Thread):
+    """
+    Answers each request on a new connection and then hangs up, like a server
+    timing out idle keep-alive connections.  Paths with 'slow' in them are
+    read and never answered.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.host = '127.0.0.1:%d' % self.sock.getsockname()[1]
+        self.paths = []
+        self.start()
+
+    def run(self):
+        while True:
+            (conn, address) = self.sock.accept()
+            data = conn.recv(65536)
+            self.paths.append(data.split(' ')[1])
+            if 'slow' in data:
+                time.sleep(1.0)
+            else:
+                conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+                time.sleep(0.05)
+            conn.close()
+
+class FakeConn(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_no_status_line(self):
+        self.assertTrue(uploader.no_status_line(httplib.BadStatusLine('')))
+        self.assertTrue(uploader.no_status_line(httplib.BadStatusLine(
+            'No status line received - the server has closed the connection')))
+        self.assertFalse(uploader.no_status_line(httplib.BadStatusLine('garbage')))
+
+    def test_closed_by_server(self):
+        (ours, theirs) = socket.socketpair()
+        self.assertFalse(uploader.closed_by_server(FakeConn(ours)))
+        theirs.close()
+        self.assertTrue(uploader.closed_by_server(FakeConn(ours)))
+        ours.close()
+        self.assertTrue(uploader.closed_by_server(FakeConn(None)))
+
+    def test_stale_connection_replaced(self):
+        server = OneShotServer()
+        pool = uploader.ConnectionPool(2, timeout=0.5)
+        self.assertEqual(pool.request('http', server.host, 'GET', '/a')[0], 200)
+        time.sleep(0.2)
+        self.assertEqual(pool.request('http', server.host, 'POST', '/b', 'x')[0], 200)
+        self.assertEqual(server.paths, ['/a', '/b'])
+        self.assertEqual((pool.created, pool.reused), (2, 0))
+
+    def test_timeout_not_resent(self):
+        server = OneShotServer()
+        pool = uploader.ConnectionPool(2, timeout=0.3)
+        self.assertRaises(socket.timeout, pool.request, 'http', server.host, 'POST', '/slow', 'x')
+        time.sleep(0.1)
+        self.assertEqual(server.paths, ['/slow'])
+
+    def test_install_counts_proxies(self):
+        class Api(object):
+            def __init__(self):
+                self.proxy = xmlrpclib.ServerProxy('http://localhost/api')
+        self.assertEqual(uploader.install_connection_pool(Api(), uploader.ConnectionPool()), 1)
+        # an api that doesn't talk xml-rpc
+        class Rest(object):
+            pass
+        self.assertEqual(uploader.install_connection_pool(Rest(), uploader.ConnectionPool()), 0)
+
+def sequences(items):
+    return [(s.pattern, s.frame_range) for s in items if isinstance(s, uploader.FrameSequence)]
+
+class FindSequencesTest(unittest.TestCase):
+    def test_few_frames_stay_files(self):
+        paths = ['IMG_%04d.jpg' % n for n in xrange(1, 4)]
+        self.assertEqual(uploader.find_sequences(paths), paths)
+
+    def test_needs_separator(self):
+        paths = ['/s/shot%04d.exr' % n for n in xrange(1, 21)]
+        self.assertEqual(uploader.find_sequences(paths), paths)
+        paths = ['/s/shot_%04d.exr' % n for n in xrange(1, 21)]
+        self.assertEqual(sequences(uploader.find_sequences(paths)), [('/s/shot_####.exr', '1-20')])
+
+    def test_unpadded_is_one_run(self):
+        paths = ['/s/shot.%d.exr' % n for n in xrange(990, 1010)]
+        self.assertEqual(sequences(uploader.find_sequences(paths)), [('/s/shot.#.exr', '990-1009')])
+
+    def test_unpadded_joins_padded(self):
+        paths = ['/s/shot.%04d.exr' % n for n in xrange(990, 1010)]
+        self.assertEqual(sequences(uploader.find_sequences(paths)), [('/s/shot.####.exr', '990-1009')])
+
+    def test_gaps(self):
+        paths = ['/s/shot.%04d.exr' % n for n in range(1, 11) + [15, 20, 21]]
+        [sequence] = uploader.find_sequences(paths)
+        self.assertEqual(sequence.frame_range, '1-21')
+        self.assertEqual(sequence.missing_text(), '11-14, 16-19')
+
+    def test_movies_stay_files(self):
+        paths = ['clip_%02d.mov' % n for n in xrange(1, 20)]
+        self.assertEqual(uploader.find_sequences(paths), paths)
+
+class Prefs(object):
+    storage_url = ''
+    path_field = ''
+    image_command = ''
+    movie_command = ''
+    sequence_command = ''
+    part_size = uploader.DEFAULT_PART_SIZE
+    part_workers = 1
+
+class Thumbnails(object):
+    def result(self, path):
+        return None
+
+class RecordingConnection(object):
+    """a shotgun connection that notes what it was asked"""
+    def __init__(self):
+        self.uploads = []
+        self.created = []
+
+    def upload(self, entity_type, entity_id, path):
+        self.uploads.append((path, os.path.exists(path)))
+        return 7
+
+    def update(self, entity_type, entity_id, data):
+        pass
+
+    def create(self, entity_type, data):
+        self.created.append((entity_type, data))
+        return {'id': len(self.created)}
+
+def sequence_file(directory, count=10):
+    paths = []
+    for n in xrange(1, count + 1):
+        paths.append(os.path.join(directory, 'shot_010.%04d.exr' % n))
+        open(paths[-1], 'w').close()
+    [sequence] = uploader.find_sequences(paths)
+    return uploader.ShotgunSequence(sequence, '', {'type': 'Shot', 'id': 1})
+
+class SequenceMovieTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_movie_sent_and_cleaned_up(self):
+        prefs = Prefs()
+        prefs.sequence_command = 'echo $first > $out'
+        conn = RecordingConnection()
+        sender = uploader.FileSender(conn, prefs, Thumbnails(), None)
+        sender.send(sequence_file(self.directory), {'type': 'Shot', 'id': 1})
+        [(path, existed)] = conn.uploads
+        self.assertTrue(existed)
+        self.assertEqual(os.path.basename(path), 'shot_010.mov')
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_failed_command_sends_frame(self):
+        prefs = Prefs()
+        prefs.sequence_command = 'false $out'
+        conn = RecordingConnection()
+        f = sequence_file(self.directory)
+        uploader.FileSender(conn, prefs, Thumbnails(), None).send(f, {'type': 'Shot', 'id': 1})
+        self.assertEqual(conn.uploads, [(f.upload_path, True)])
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = uploader.SearchIndex()
+        self.index.add([('', 0), ('Shot A', 5), ('shot a', 6), ('Shot B', 7), ('Shot B', 8), ('Shot C', 9)])
+
+    def test_unique_name(self):
+        self.assertEqual([self.index.data[n] for n in self.index.ids('Shot C')], [9])
+        self.assertEqual([self.index.data[n] for n in self.index.ids('shot c')], [9])
+
+    def test_exact_case_decides(self):
+        self.assertEqual([self.index.data[n] for n in self.index.ids('Shot A')], [5])
+        self.assertEqual([self.index.data[n] for n in self.index.ids('shot a')], [6])
+
+    def test_ambiguous(self):
+        self.assertEqual(len(self.index.ids('SHOT A')), 2)
+        self.assertEqual(len(self.index.ids('Shot B')), 2)
+
+    def test_unknown(self):
+        self.assertEqual(self.index.ids('Shot D'), [])
+
+    def test_search_keeps_duplicates(self):
+        self.assertEqual(sorted([self.index.data[n] for n in self.index.search('shot b')[:2]]), [7, 8])
+
+class Row(object):
+    def __init__(self, path, link_name=''):
+        self.path = path
+        self.display_path = path
+        self.link_name = link_name
+        self.size = len(path)
+        self.hero_offset = ''
+        self.tags = ''
+        self.note = ''
+
+class FileList(object):
+    """just enough of a ShotgunFileModel to sit under a FileFilterModel"""
+    def __init__(self, paths):
+        self.files = [Row(path) for path in paths]
+
+    def rowCount(self, parent=None):
+        return len(self.files)
+
+    def column_attr(self, column):
+        return ['hero_offset', 'display_path', 'link_name', 'tags', 'note'][column]
+
+    def headerData(self, section, orientation, role):
+        return 'header %d' % section
+
+def filter_model(source, text, column):
+    model = uploader.FileFilterModel()
+    model.sourceModel = lambda: source
+    model.persistentIndexList = lambda: []
+    model.sort(column)
+    model.set_filter(text)
+    return model
+
+def shown(model):
+    return [model.sourceModel().files[row].path for row in model._FileFilterModel__rows]
+
+class FileFilterModelTest(unittest.TestCase):
+    def setUp(self):
+        self.source = FileList(['/a/shot_%02d.exr' % n for n in (5, 1, 9, 3, 7, 2, 8)] + ['/a/notes.txt'])
+        self.model = filter_model(self.source, 'exr', 1)
+        self.kept = self.model._FileFilterModel__keys[1]
+
+    def check(self):
+        """the same rows in the same order as a model built over the files as they are now"""
+        fresh = filter_model(self.source, 'exr', 1)
+        self.assertEqual(shown(self.model), shown(fresh))
+        for (row, source_row) in enumerate(self.model._FileFilterModel__rows):
+            self.assertEqual(self.model.source_row(row), source_row)
+        # kept, not thrown away and pulled out again
+        keys = self.model._FileFilterModel__keys
+        self.assertTrue(keys[1] is self.kept)
+        self.assertEqual(keys[1], fresh._FileFilterModel__key(1))
+        self.assertEqual(keys['path'], fresh._FileFilterModel__key('path'))
+
+    def test_insert_in_middle(self):
+        self.model._FileFilterModel__about_to_insert(None, 3, 4)
+        self.source.files[3:3] = [Row('/a/shot_04.exr'), Row('/a/shot_04.txt')]
+        self.model._FileFilterModel__inserted(None, 3, 4)
+        self.assertTrue('/a/shot_04.exr' in shown(self.model))
+        self.assertFalse('/a/shot_04.txt' in shown(self.model))
+        self.check()
+
+    def test_remove_in_middle(self):
+        self.model._FileFilterModel__about_to_remove(None, 2, 4)
+        del self.source.files[2:5]
+        self.model._FileFilterModel__removed(None, 2, 4)
+        self.assertEqual(len(shown(self.model)), 4)
+        self.check()
+
+    def test_insert_then_remove(self):
+        self.model._FileFilterModel__about_to_insert(None, 1, 1)
+        self.source.files.insert(1, Row('/a/shot_06.exr'))
+        self.model._FileFilterModel__inserted(None, 1, 1)
+        self.model._FileFilterModel__about_to_remove(None, 4, 5)
+        del self.source.files[4:6]
+        self.model._FileFilterModel__removed(None, 4, 5)
+        self.check()
+
+    def test_link_index_follows_rows(self):
+        self.source.files[0].link_name = 'Shot A'
+        model = filter_model(self.source, 'link:shot', -1)
+        model._FileFilterModel__about_to_insert(None, 0, 0)
+        self.source.files.insert(0, Row('/a/shot_00.exr', 'Shot B'))
+        model._FileFilterModel__inserted(None, 0, 0)
+        self.assertEqual(shown(model), ['/a/shot_00.exr', '/a/shot_05.exr'])
+        model._FileFilterModel__about_to_remove(None, 0, 0)
+        del self.source.files[0]
+        model._FileFilterModel__removed(None, 0, 0)
+        self.assertEqual(shown(model), ['/a/shot_05.exr'])
+        self.assertEqual(model._FileFilterModel__keys['link'], {'shot a': [0], '': range(1, 8)})
+
+    def test_header_with_no_rows(self):
+        self.model.set_filter('nothing')
+        self.assertEqual(shown(self.model), [])
+        self.assertEqual(self.model.headerData(2, uploader.QtCore.Qt.Horizontal), 'header 2')
+
+def recording(obj):
+    """obj with what it emits kept in obj.emitted instead of sent anywhere"""
+    obj.emitted = []
+    obj.emit = lambda signal, *args: obj.emitted.append(args)
+    return obj
+
+class DropFeederTest(unittest.TestCase):
+    def setUp(self):
+        self.feeder = recording(uploader.DropFeeder(2))
+
+    def test_cancel(self):
+        first = self.feeder.feed(['a', 'b', 'c'])
+        second = self.feeder.feed(['d'])
+        self.feeder.cancel(first)
+        self.assertEqual(self.feeder.emitted, [(first,)])
+        self.assertEqual(self.feeder.remaining(), 1)
+        # already gone, nothing more to say about it
+        self.feeder.cancel(first)
+        self.assertEqual(len(self.feeder.emitted), 1)
+        self.feeder._DropFeeder__next_batch()
+        self.assertEqual(self.feeder.emitted[1:], [(['d'], second), (second,)])
+
+    def test_cancel_part_way(self):
+        drop = self.feeder.feed(['a', 'b', 'c'])
+        self.feeder._DropFeeder__next_batch()
+        self.feeder.cancel(drop)
+        self.assertEqual(self.feeder.emitted, [(['a', 'b'], drop), (drop,)])
+        self.assertEqual(self.feeder.remaining(), 0)
+
+class LinkResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.resolver = recording(uploader.LinkResolver())
+        self.stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def run_jobs(self):
+        self.resolver._LinkResolver__jobs.put(None)
+        self.resolver.run()
+
+    def test_find_raising(self):
+        def find(name):
+            if name == 'b':
+                raise xmlrpclib.Fault(1, 'no')
+            return {'type': 'Shot', 'name': name}
+        self.resolver.resolve(['a', 'b', 'c'], 1, find)
+        self.resolver.finish(1)
+        self.run_jobs()
+        self.assertEqual(self.resolver.emitted, [([('a', find('a')), ('b', None), ('c', find('c'))], 1), (1,)])
+        self.assertTrue('b' in sys.stderr.getvalue())
+
+    def test_every_batch_answered(self):
+        def find(name):
+            raise socket.error('down')
+        self.resolver.resolve(['a'], 1, find)
+        self.resolver.resolve(['b'], 1, find)
+        self.run_jobs()
+        self.assertEqual(self.resolver.emitted, [([('a', None)], 1), ([('b', None)], 1)])
+        self.assertEqual(self.resolver.pending, 2)
+
+class FlakyConnection(RecordingConnection):
+    """fails the first update after the upload, like a dropped connection would"""
+    def __init__(self):
+        RecordingConnection.__init__(self)
+        self.fail = True
+
+    def update(self, entity_type, entity_id, data):
+        if self.fail:
+            self.fail = False
+            raise socket.error('connection reset')
+
+class SpoolWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = uploader.Spool(os.path.join(self.directory, 'spool'))
+        path = os.path.join(self.directory, 'notes.txt')
+        open(path, 'w').write('notes')
+        self.file = uploader.ShotgunFile(path, '', {'type': 'Shot', 'id': 1})
+        [self.job_id] = self.spool.enqueue([{'file': self.file.to_dict(), 'default_link': {'type': 'Shot', 'id': 1}}])
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def test_lost_lease(self):
+        keeper = uploader.LeaseKeeper(self.spool.directory, self.job_id, 'a')
+        keeper.check()
+        keeper.lost = True
+        self.assertRaises(uploader.LeaseLost, keeper.check)
+
+    def test_lease_runs_out(self):
+        # never started, so nothing renews it
+        keeper = uploader.LeaseKeeper(self.spool.directory, self.job_id, 'a', 0.05)
+        time.sleep(0.1)
+        self.assertRaises(uploader.LeaseLost, keeper.check)
+
+    def test_retry_keeps_attachment(self):
+        conn = FlakyConnection()
+        worker = uploader.SpoolWorker(self.spool, uploader.FileSender(conn, Prefs(), Thumbnails(), None), 'a')
+        self.assertTrue(isinstance(worker.work(*worker.claim()), socket.error))
+        (job_id, f, payload) = worker.claim()
+        self.assertEqual(payload['attachment_id'], 7)
+        self.assertEqual(worker.work(job_id, f, payload), None)
+        self.assertEqual(len(conn.uploads), 1)
+        self.assertEqual(self.spool.counts()['done'], 1)
+
+    def test_close_drops_storage_connections(self):
+        prefs = Prefs()
+        prefs.storage_url = 'http://127.0.0.1:1/uploads'
+        sender = uploader.FileSender(RecordingConnection(), prefs, Thumbnails(), None)
+        pool = sender.multipart.pool
+        # as left by a part upload, kept open for the next one
+        (conn, reused) = pool._ConnectionPool__checkout('http', '127.0.0.1:1')
+        pool._ConnectionPool__checkin('http', '127.0.0.1:1', conn, True)
+        closed = []
+        conn.close = lambda: closed.append(conn)
+        uploader.SpoolWorker(self.spool, sender, 'a').close()
+        self.assertEqual(closed, [conn])
+        self.assertEqual(pool._ConnectionPool__open, 0)
+        # and a worker with no storage to talk to closes fine
+        uploader.SpoolWorker(self.spool, uploader.FileSender(RecordingConnection(), Prefs(), Thumbnails(), None), 'b').close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,10 +15,20 @@ DEFAULT_SHOTGUN_API = "/net/a/place/where/we/put/the/shotgun_api3.py"
 DEFAULT_SHOTGUN_URL = "http://shotgun.kickass-studios.com/"
 DEFAULT_SHOTGUN_SCRIPT = "thumb_uploader"
 DEFAULT_SHOTGUN_KEY = "ALONGSTRINGOFNUMBERSANDLETTERSFROMSHOTGUN"
-DEFAULT_IMAGE_COMMAND = "convert $in $out"
-DEFAULT_MOVIE_COMMAND = "ffmpeg -y -i $in -f mjpeg -ss $offset -vframes 1 -s svga -an $out"
+DEFAULT_IMAGE_COMMAND = "convert $in -thumbnail 800x600 jpeg:-"
+DEFAULT_MOVIE_COMMAND = "ffmpeg -v error -i $in -f mjpeg -ss $offset -vframes 1 -s svga -an pipe:1"
 DEFAULT_TAGS = "to_be_filed"
 DEFAULT_PATH_FIELD = "sg_path_to_file"
+DEFAULT_SEQUENCE_COMMAND = ""
+DEFAULT_PROXIES = False
+DEFAULT_SEQUENCES = False
+DEFAULT_PROXY_RULES = """\
+image: max=2048x2048 quality=85
+video: max=1920x1080 codec=libx264 quality=23
+"""
+DEFAULT_STORAGE_URL = ""
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_PART_WORKERS = 8
 DEFAULT_LINK_MAP = """\
 Asset: /job_root/*/assets/$type/${name}
 Task: /job_root/*/shots/$entity.Shot.name/${name}
@@ -30,11 +40,29 @@ Task: /job_root/*/shots/$entity.Shot.name/${name}
 import re
 import os
 import sys
+import time
+import errno
+import uuid
+import bisect
+import hashlib
+import shutil
 import urllib
+import urlparse
+import mimetools
+import Queue
+import thread
 import socket
+import select
+import httplib
+import sqlite3
 import optparse
+import xmlrpclib
+import threading
 import tempfile
 import mimetypes
+import cStringIO
+import traceback
+import subprocess
 
 from PyQt4 import QtGui
 from PyQt4 import QtCore
@@ -46,218 +74,3024 @@ except:
     # to work when catt'ed together for standalone emailing
     pass
 
-################################################################################
-# Globals
-################################################################################
-DEFAULT_COL_WIDTHS = "44,406,64,274,274"
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        # no in process thumbnails, always fall back to the image command
+        Image = None
+
+try:
+    import multiprocessing
+except ImportError:
+    # python 2.5, proxies get made one at a time
+    multiprocessing = None
+
+try:
+    import json
+except ImportError:
+    # python 2.5, no spool
+    json = None
+
+try:
+    import cProfile
+except ImportError:
+    # not in every build, no profiling
+    cProfile = None
+
+################################################################################
+# Globals
+################################################################################
+DEFAULT_COL_WIDTHS = "44,406,64,274,274"
+# most keep-alive connections to hold open to shotgun at once
+DEFAULT_POOL_SIZE = 8
+# bounding box for thumbnails, matches the svga of the movie command
+THUMBNAIL_SIZE = (800, 600)
+# most bytes a thumbnail command can hand back before it's given up on
+THUMBNAIL_MAX_BYTES = 4 * 1024 * 1024
+# threads making thumbnails, and how many files ahead of the upload they work
+DEFAULT_THUMBNAIL_WORKERS = 4
+THUMBNAIL_LOOKAHEAD = 8
+# frames in a hero frame filmstrip, and how many movies to keep them cached for
+FILMSTRIP_FRAMES = 12
+FILMSTRIP_CACHE_SIZE = 32
+# tools used to pull filmstrips out of movies
+FFMPEG = "ffmpeg"
+FFPROBE = "ffprobe"
+# fewest numbered frames that get collapsed into a sequence, fewer are left as
+# files so a handful of numbered photos don't turn into one
+MIN_SEQUENCE_FRAMES = 10
+# dropped files handed to the window at a time, the ui gets a turn between
+DROP_BATCH_SIZE = 500
+# processes making proxies, and how many files ahead of the upload they work,
+# which bounds the disk the proxies waiting to go take up
+DEFAULT_PROXY_WORKERS = 4
+PROXY_LOOKAHEAD = 8
+# most matches the link name completer offers, and how many names a view gets at a time
+LINK_SEARCH_LIMIT = 100
+LINK_FETCH_SIZE = 200
+# entities fetched from shotgun per request when loading link names
+LINK_PAGE_SIZE = 500
+# seconds for an old upload rate sample to count half as much as a new one
+RATE_HALF_LIFE = 20.0
+# a file taking this many times longer than expected, and at least
+# STALL_SECONDS, counts as stalled
+STALL_FACTOR = 3.0
+STALL_SECONDS = 60.0
+# times a part of a multipart upload is tried before the upload fails
+PART_RETRIES = 4
+# milliseconds typing has to stop for before the file filter is applied
+FILTER_DELAY = 150
+# seconds the event loop can go without turning before it counts as stalled,
+# and milliseconds between checks that it's turning
+STALL_THRESHOLD = 2.0
+STALL_HEARTBEAT = 100
+# seconds a spool worker holds a job without checking in before others can take
+# it, how often idle workers look for more, and tries before a job is failed
+SPOOL_LEASE = 300.0
+SPOOL_POLL = 5.0
+SPOOL_ATTEMPTS = 3
+
+################################################################################
+# Connection Pool
+################################################################################
+class ConnectionPool(object):
+    """
+    Bounded pool of persistent keep-alive http(s) connections.
+
+    A connection is checked out for a single request and handed back when the
+    response has been read, so any number of threads can share one pool.  No
+    more than maxsize connections are ever open; extra callers wait their turn.
+    """
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.__cond = threading.Condition()
+        # (scheme, host) -> idle connections to it
+        self.__idle = {}
+        # open connections, idle or checked out
+        self.__open = 0
+        # stats
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+
+    def __checkout(self, scheme, host):
+        """return (connection, reused), waiting for a free slot if need be"""
+        key = (scheme, host)
+        self.__cond.acquire()
+        try:
+            while True:
+                idle = self.__idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    if closed_by_server(conn):
+                        conn.close()
+                        self.__open -= 1
+                        continue
+                    self.reused += 1
+                    return (conn, True)
+                if self.__open < self.maxsize:
+                    self.__open += 1
+                    self.created += 1
+                    break
+                # pool is full, make room by dropping an idle connection to
+                # some other host before resorting to waiting
+                others = [conns for conns in self.__idle.itervalues() if conns]
+                if others:
+                    others[0].pop().close()
+                    self.__open -= 1
+                    continue
+                self.__cond.wait()
+        finally:
+            self.__cond.release()
+        # the slot is ours, connect outside the lock
+        if scheme == 'https':
+            return (httplib.HTTPSConnection(host, timeout=self.timeout), False)
+        return (httplib.HTTPConnection(host, timeout=self.timeout), False)
+
+    def __checkin(self, scheme, host, conn, keep):
+        self.__cond.acquire()
+        try:
+            if keep:
+                self.__idle.setdefault((scheme, host), []).append(conn)
+            else:
+                conn.close()
+                self.__open -= 1
+            self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+    def request(self, scheme, host, method, url, body=None, headers={}):
+        """
+        Send a request over a pooled connection.
+        Returns (status, reason, response headers, response body).
+        """
+        headers = dict(headers)
+        headers.setdefault('Connection', 'keep-alive')
+        self.__cond.acquire()
+        self.requests += 1
+        self.__cond.release()
+        while True:
+            (conn, reused) = self.__checkout(scheme, host)
+            if hasattr(body, 'seek'):
+                # a file like body may be partly read by a failed try
+                body.seek(0)
+            # only retry when the server can't have seen the request, anything
+            # else might have been acted on and sending it again could repeat it
+            try:
+                conn.request(method, url, body, headers)
+            except (httplib.HTTPException, socket.error), e:
+                self.__checkin(scheme, host, conn, False)
+                if reused and getattr(e, 'errno', None) in (errno.ECONNRESET, errno.EPIPE):
+                    # the server had already closed the idle connection
+                    continue
+                raise
+            try:
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                self.__checkin(scheme, host, conn, False)
+                if reused and isinstance(e, httplib.BadStatusLine) and no_status_line(e):
+                    # closed without a byte of response, the server timed out
+                    # the idle connection rather than taking the request
+                    continue
+                raise
+            self.__checkin(scheme, host, conn, not response.will_close)
+            return (response.status, response.reason, response.msg, data)
+
+    def stats(self):
+        """human readable summary of connection reuse"""
+        return "%d requests over %d connections (%d reused)" % (self.requests, self.created, self.reused)
+
+    def close(self):
+        """close all idle connections"""
+        self.__cond.acquire()
+        try:
+            for conns in self.__idle.itervalues():
+                for conn in conns:
+                    conn.close()
+                    self.__open -= 1
+            self.__idle = {}
+        finally:
+            self.__cond.release()
+
+def closed_by_server(conn):
+    """
+    Has the server hung up on an idle connection.  Nothing is owed on an idle
+    one, so anything to read is the close (or junk) and it can't be used.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error):
+        return True
+
+def no_status_line(e):
+    """is a BadStatusLine for a connection that closed before sending anything"""
+    # python 2.7 versions differ in what they put in an empty status line error
+    return e.line in ('', "''", '""') or e.line.startswith('No status line')
+
+################################################################################
+class PooledTransport(xmlrpclib.Transport):
+    """xml-rpc transport that sends every call through a ConnectionPool"""
+    def __init__(self, pool, scheme='http', use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.pool = pool
+        self.scheme = scheme
+
+    def request(self, host, handler, request_body, verbose=0):
+        (host, extra_headers, x509) = self.get_host_info(host)
+        headers = dict(extra_headers or [])
+        headers['Content-Type'] = 'text/xml'
+        headers['User-Agent'] = self.user_agent
+        (status, reason, msg, data) = self.pool.request(self.scheme, host, 'POST', handler, request_body, headers)
+        if status != 200:
+            raise xmlrpclib.ProtocolError(host + handler, status, reason, msg)
+        self.verbose = verbose
+        (parser, unmarshaller) = self.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
+
+# what to say when install_connection_pool finds nothing to switch over
+NO_POOL_WARNING = "This Shotgun api has no xml-rpc proxy to route through the connection pool, " \
+    "Shotgun calls won't share connections."
+
+def install_connection_pool(conn, pool):
+    """
+    Route the xml-rpc calls of a shotgun connection through pool.
+    Returns the number of server proxies that were switched over, 0 if the
+    api isn't built the way this expects and calls go the api's own way.
+    """
+    installed = 0
+    for value in conn.__dict__.values():
+        if isinstance(value, xmlrpclib.ServerProxy):
+            transport = value._ServerProxy__transport
+            scheme = isinstance(transport, xmlrpclib.SafeTransport) and 'https' or 'http'
+            use_datetime = getattr(transport, '_use_datetime', 0)
+            value._ServerProxy__transport = PooledTransport(pool, scheme, use_datetime)
+            installed += 1
+    return installed
+
+def encode_multipart(fields, files):
+    """
+    Body and content type for a multipart/form-data post of fields, a list of
+    (name, value), and files, a list of (name, filename, data).
+    """
+    boundary = mimetools.choose_boundary()
+    lines = []
+    for (name, value) in fields:
+        lines.extend(['--' + boundary, 'Content-Disposition: form-data; name="%s"' % name, '', str(value)])
+    for (name, filename, data) in files:
+        lines.extend(['--' + boundary,
+            'Content-Disposition: form-data; name="%s"; filename="%s"' % (name, filename),
+            'Content-Type: %s' % (mimetypes.guess_type(filename)[0] or 'application/octet-stream'), '', data])
+    lines.extend(['--' + boundary + '--', ''])
+    return ('\r\n'.join(lines), 'multipart/form-data; boundary=%s' % boundary)
+
+# The shotgun python api (shotgun_api3 3.x) only uploads thumbnails from a
+# file.  Its upload_thumbnail posts the image as form data to this path under
+# base_url, signed with script_name and api_key.  post_thumbnail makes the same
+# post from memory, so it leans on those undocumented attributes and on the
+# path.  Apis without them are left to upload_thumbnail, and FileSender goes
+# back to upload_thumbnail for good if the post is ever turned away.
+THUMBNAIL_POST_PATH = '/upload/publish_thumbnail'
+THUMBNAIL_POST_ATTRS = ('base_url', 'script_name', 'api_key')
+
+def can_post_thumbnail(conn):
+    """does conn have what post_thumbnail needs"""
+    for attr in THUMBNAIL_POST_ATTRS:
+        value = getattr(conn, attr, None)
+        if not value or not isinstance(value, basestring):
+            return False
+    return True
+
+def post_thumbnail(conn, pool, entity_type, entity_id, data):
+    """
+    Send jpeg data as the thumbnail of an entity, the same post that
+    conn.upload_thumbnail makes but from memory rather than a file.  Only for
+    connections can_post_thumbnail says yes to.
+    """
+    (scheme, host, path) = urlparse.urlsplit(conn.base_url)[:3]
+    fields = [('entity_type', entity_type), ('entity_id', entity_id),
+        ('script_name', conn.script_name), ('script_key', conn.api_key)]
+    (body, content_type) = encode_multipart(fields, [('thumb_image', 'thumbnail.jpg', data)])
+    headers = {'Content-Type': content_type, 'Content-Length': str(len(body))}
+    (status, reason, msg, result) = pool.request(scheme, host, 'POST',
+        path.rstrip('/') + THUMBNAIL_POST_PATH, body, headers)
+    # shotgun answers 1 and then some on success
+    if status != 200 or not result.startswith('1'):
+        raise IOError('thumbnail upload failed: %s %s %s' % (status, reason, result[:200]))
+
+################################################################################
+# Model
+################################################################################
+class ShotgunFileModel(QtCore.QAbstractTableModel):
+    # Mapping from display text to an attribute of the modeled object
+    __HEADERS = [
+        {'disp': 'Frame', 'attr': 'hero_offset', 'default': '', 'editable': True},
+        {'disp': 'Path', 'attr': 'display_path', 'default': '', 'editable': False},
+        {'disp': 'Linked To', 'attr': 'link_name', 'default': '', 'editable': False},
+        {'disp': 'Tags', 'attr': 'tags', 'default': '', 'editable': True},
+        {'disp': 'Note', 'attr': 'note', 'default': '', 'editable': True},
+    ]
+
+    # model methods
+    def __init__(self, undo_stack, parent=None):
+        """constructor"""
+        super(ShotgunFileModel, self).__init__(parent)
+        self.stack = undo_stack
+        self.files = []
+        # drops come back out as filesAdded(QStringList, int) a batch at a time
+        self.feeder = DropFeeder(parent=self)
+        self.connect(self.feeder, QtCore.SIGNAL('filesAdded(QStringList, int)'),
+            self, QtCore.SIGNAL('filesAdded(QStringList, int)'))
+        self.connect(self.feeder, QtCore.SIGNAL('dropFinished(int)'), self, QtCore.SIGNAL('dropFinished(int)'))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        """number of rows is the number of files"""
+        return len(self.files)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        """number of columns is the number of headers"""
+        return len(self.__HEADERS)
+
+    def column_for(self, attr):
+        """column showing attr of the modeled objects"""
+        return [h['attr'] for h in self.__HEADERS].index(attr)
+
+    def column_attr(self, column):
+        """attr of the modeled objects shown in column"""
+        return self.__HEADERS[column]['attr']
+
+    def editable_columns(self):
+        """(column, header text) for columns that can be edited"""
+        return [(i, h['disp']) for (i, h) in enumerate(self.__HEADERS) if h['editable']]
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        """method to return data for the various display roles in qt"""
+        # display role, actually return the info
+        if index.isValid() and role == QtCore.Qt.DisplayRole:
+            f = self.files[index.row()]
+            attr = self.__HEADERS[index.column()]['attr']
+            ret = getattr(f, attr, None)
+            if ret is not None:
+                return QtCore.QVariant(ret)
+            else:
+                return QtCore.QVariant(self.__HEADERS[index.column()]['default'])
+        # not worrying about this role, just return invalid variant
+        return QtCore.QVariant()
+
+    def headerData(self, section, orientation, role):
+        """return data for header row"""
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole and 0 <= section < len(self.__HEADERS):
+            return QtCore.QVariant(self.__HEADERS[section]['disp'])
+        return QtCore.QVariant()
+
+    def setData(self, index, value, role):
+        """set data for a given index"""
+        if (role != QtCore.Qt.EditRole):
+            return False
+        self.stack.push(ChangeValueCommand(index, value, self))
+        return True
+
+    # drag and drop methods
+    def supportedDropActions(self):
+        """what drop actions do we support, treat move or copy as an insert"""
+        return QtCore.Qt.MoveAction | QtCore.Qt.CopyAction
+
+    def flags(self, index):
+        """all items can accept drops, hero_offset is editable for video, otherwise use editable"""
+        flags = QtCore.Qt.ItemIsDropEnabled | QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if self.__HEADERS[index.column()]['attr'] == 'hero_offset':
+            f = self.files[index.row()]
+            mime_guess = mimetypes.guess_type(f.path)[0]
+            if mime_guess is not None and mime_guess.startswith('video'):
+                flags |= QtCore.Qt.ItemIsEditable
+        elif self.__HEADERS[index.column()]['editable']:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def mimeTypes(self):
+        """return a list of supported mime types.  enables drop"""
+        # text/uri-list is what most finder style file browsers use
+        return QtCore.QStringList(['text/uri-list'])
+
+    def dropMimeData(self, data, action, row, column, parent):
+        """handle the drop action, currently just uri-list"""
+        if data.hasFormat('text/uri-list'):
+            # straight from the raw list, no QUrl for every file
+            uris = [uri for uri in str(data.data('text/uri-list')).splitlines() if not uri.startswith('#')]
+        elif data.hasText():
+            uris = str(data.text()).split()
+        else:
+            return False
+        paths = [path for path in [uri_to_path(uri) for uri in uris] if path]
+        if paths:
+            # Just let people know what's been added, a batch at a time so the
+            # drop returns right away
+            self.feeder.feed(paths)
+        return True
+
+    # model object access
+    def _update_data(self, row, column, value):
+        """update internal data at (row, column) to value"""
+        f = self.files[row]
+        setattr(f, self.__HEADERS[column]['attr'], str(value))
+        index = self.index(row, column)
+        self.emit(QtCore.SIGNAL('dataChanged(QModelIndex, QModelIndex)'), index, index)
+
+    def _update_rows(self, column, values):
+        """set column for many rows at once from a {row: value} dict, with one change notification"""
+        if not values:
+            return
+        attr = self.__HEADERS[column]['attr']
+        for (row, value) in values.iteritems():
+            setattr(self.files[row], attr, value)
+        # one range covering them all, rows in between just get repainted
+        top = self.index(min(values), column)
+        bottom = self.index(max(values), column)
+        self.emit(QtCore.SIGNAL('dataChanged(QModelIndex, QModelIndex)'), top, bottom)
+
+    def clear(self):
+        self.files = []
+        self.reset()
+
+    def insert_files(self, files, row):
+        self.beginInsertRows(QtCore.QModelIndex(), row, row+len(files)-1)
+        self.files[row:row] = files
+        self.endInsertRows()
+
+    def append_files(self, files):
+        self.insert_files(files, len(self.files))
+
+    def delete_files(self, first, last):
+        """delete rows first up to but not including last"""
+        self.beginRemoveRows(QtCore.QModelIndex(), first, last-1)
+        self.files[first:last] = []
+        self.endRemoveRows()
+
+################################################################################
+def uri_to_path(uri):
+    """the path of a local file: uri, None for anything else.  Nothing gets fetched or copied"""
+    (scheme, host, path) = urlparse.urlsplit(uri.strip())[:3]
+    if scheme != 'file' or host not in ('', 'localhost'):
+        return None
+    return urllib.url2pathname(path)
+
+def frame_match(path, stills):
+    """
+    FRAME_RE match of path if it could be a frame of a sequence, None if not.
+    Only stills make sequences, clip1.mov and clip2.mov are two movies, and
+    stills caches whether each extension is a still.
+    """
+    match = FRAME_RE.match(path)
+    if match is None:
+        return None
+    tail = match.group('tail')
+    if tail not in stills:
+        mime = mimetypes.guess_type('frame' + tail)[0]
+        stills[tail] = (mime is None or mime.startswith('image'))
+    if not stills[tail]:
+        return None
+    return match
+
+def run_key(path, stills):
+    """
+    What the frames of the sequence path could be part of have in common, None
+    if it can't be part of one.  Goes by the same rules as find_sequences.
+    """
+    match = frame_match(path, stills)
+    if match is None:
+        return None
+    return (match.group('head'), match.group('tail'))
+
+class DropFeeder(QtCore.QObject):
+    """
+    Hands out dropped paths from the event loop in batches of batch_size, so
+    a drop of thousands of files doesn't hold up the ui until they're all in.
+
+    When sequences is set, frames of a sequence are kept together so one isn't
+    split across batches, which means paths come out grouped by sequence
+    rather than as dropped.
+    Emits filesAdded(QStringList, int) for each batch with the number of the
+    drop it came from, and dropFinished(int) after its last one.
+    """
+    def __init__(self, batch_size=DROP_BATCH_SIZE, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.batch_size = batch_size
+        self.sequences = False
+        self.drops = 0
+        # extension -> is it a still, for run_key
+        self.__stills = {}
+        # [drop, paths, how far along] for drops still going
+        self.__pending = []
+        self.__timer = QtCore.QTimer(self)
+        self.__timer.setInterval(0)
+        self.connect(self.__timer, QtCore.SIGNAL('timeout()'), self.__next_batch)
+
+    def feed(self, paths):
+        """queue up paths, returning the number of the drop they'll come out as"""
+        self.drops += 1
+        if self.sequences:
+            paths = sorted(paths, key=lambda path: (run_key(path, self.__stills) or (path, ''), path))
+        self.__pending.append([self.drops, paths, 0])
+        self.__timer.start()
+        return self.drops
+
+    def cancel(self, drop):
+        """hand out no more of drop, it still finishes with dropFinished(int)"""
+        for pending in self.__pending:
+            if pending[0] == drop:
+                self.__pending.remove(pending)
+                self.emit(QtCore.SIGNAL('dropFinished(int)'), drop)
+                break
+
+    def remaining(self):
+        """paths not handed out yet"""
+        return sum([len(paths) - done for (drop, paths, done) in self.__pending])
+
+    def __next_batch(self):
+        if not self.__pending:
+            self.__timer.stop()
+            return
+        (drop, paths, start) = self.__pending[0]
+        end = min(start + self.batch_size, len(paths))
+        # finish off the sequence the batch ends in
+        key = self.sequences and run_key(paths[end-1], self.__stills) or None
+        while key is not None and end < len(paths) and run_key(paths[end], self.__stills) == key:
+            end += 1
+        self.__pending[0][2] = end
+        if end >= len(paths):
+            self.__pending.pop(0)
+        self.emit(QtCore.SIGNAL('filesAdded(QStringList, int)'), paths[start:end], drop)
+        if end >= len(paths):
+            self.emit(QtCore.SIGNAL('dropFinished(int)'), drop)
+        if not self.__pending:
+            self.__timer.stop()
+
+class LinkResolver(QtCore.QThread):
+    """
+    Works out links for batches of dropped files off the ui thread, since the
+    link map can mean asking shotgun about every one of them.
+
+    resolve(items, drop, find) queues a batch where find(name) is the link for
+    a name, and linksResolved(PyQt_PyObject, int) hands back [(item, link)]
+    with the drop number, the link being None where find raised.  finish(drop) queues dropResolved(int) behind the
+    drop's batches.  Everything comes back in the order it was queued.
+    """
+    def __init__(self, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.__jobs = Queue.Queue()
+        # batches and finishes queued but not handed back yet, only touched
+        # on the ui thread
+        self.pending = 0
+
+    def resolve(self, items, drop, find):
+        self.__put((items, drop, find))
+
+    def finish(self, drop):
+        self.__put((None, drop, None))
+
+    def done(self):
+        """one of the queued results has been dealt with"""
+        self.pending -= 1
+
+    def __put(self, job):
+        self.pending += 1
+        self.__jobs.put(job)
+        if not self.isRunning():
+            self.start()
+
+    def stop(self):
+        """drop whatever hasn't been started on and wait for the thread"""
+        try:
+            while True:
+                self.__jobs.get_nowait()
+        except Queue.Empty:
+            pass
+        self.__jobs.put(None)
+        self.wait()
+        self.pending = 0
+
+    def run(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                return
+            (items, drop, find) = job
+            if items is None:
+                self.emit(QtCore.SIGNAL('dropResolved(int)'), drop)
+                continue
+            links = []
+            try:
+                for item in items:
+                    # sequences get linked by the name of the whole run
+                    if isinstance(item, FrameSequence):
+                        name = item.pattern
+                    else:
+                        name = item
+                    try:
+                        link = find(name)
+                    except Exception, e:
+                        # left unlinked, it gets skipped along with the rest
+                        # that have no link
+                        print >> sys.stderr, 'failed to link %s: %s' % (name, e)
+                        link = None
+                    links.append((item, link))
+            finally:
+                # the ui waits on every batch coming back before it can upload
+                self.emit(QtCore.SIGNAL('linksResolved(PyQt_PyObject, int)'), links, drop)
+
+################################################################################
+def row_runs(rows):
+    """sorted rows as (first, last) runs of consecutive rows"""
+    runs = []
+    for row in rows:
+        if runs and runs[-1][1] == row - 1:
+            runs[-1][1] = row
+        else:
+            runs.append([row, row])
+    return [tuple(run) for run in runs]
+
+def lowered(text):
+    """lower case utf-8 for paths, names and what's typed to compare alike"""
+    if not isinstance(text, str):
+        text = unicode(text).encode('utf-8')
+    return text.lower()
+
+# size filters, size>100M or size<2k
+SIZE_FILTER_RE = re.compile(r'^size(?P<op>[<>])(?P<number>\d+(\.\d+)?)(?P<unit>[kmgt]?)b?$')
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+
+class FileFilter(object):
+    """
+    A filter typed in over the file queue.  Words have to all be in the path.
+    link:NAME and type:TYPE match if any of their kind do, TYPE being a mime
+    type (image/tiff), the first half of one (video) or an extension (exr).
+    size>N and size<N take k, M, G, and T suffixes.  Case doesn't matter.
+    """
+    def __init__(self, text):
+        self.words = []
+        self.links = []
+        self.types = []
+        self.min_size = None
+        self.max_size = None
+        for token in lowered(text).split():
+            match = SIZE_FILTER_RE.match(token)
+            if match:
+                size = int(float(match.group('number')) * SIZE_UNITS[match.group('unit')])
+                if match.group('op') == '>':
+                    self.min_size = size
+                else:
+                    self.max_size = size
+            elif token.startswith('link:') and len(token) > 5:
+                self.links.append(token[5:])
+            elif token.startswith('type:') and len(token) > 5:
+                self.types.append(token[5:].lstrip('.'))
+            else:
+                self.words.append(token)
+
+    def empty(self):
+        return not (self.words or self.links or self.types or self.min_size is not None or self.max_size is not None)
+
+    def narrows(self, other):
+        """is everything this matches also matched by other, so it only needs to look through other's matches"""
+        if other is None:
+            return False
+        if (self.links, self.types, self.min_size, self.max_size) != \
+                (other.links, other.types, other.min_size, other.max_size):
+            return False
+        # typing more of a word, or another word, only ever matches fewer paths
+        for old in other.words:
+            if not [word for word in self.words if old in word]:
+                return False
+        return True
+
+class FileFilterModel(QtGui.QAbstractProxyModel):
+    """
+    Filtered and sorted view of a ShotgunFileModel, without changing the order
+    files upload in.
+
+    QSortFilterProxyModel calls back into python for every row it filters and
+    every comparison it sorts, far too slow for 100k rows.  Here the values
+    filtered and sorted on are pulled out once into lists indexed by source row,
+    links and types are indexed by name, and the filtering and sorting are done
+    over those lists in one go.  When a filter only adds to the last one, just
+    the rows that matched last time are looked at.  With no filter and no sort
+    rows pass straight through.
+    """
+    def __init__(self, parent=None):
+        QtGui.QAbstractProxyModel.__init__(self, parent)
+        self.query = FileFilter('')
+        self.sort_column = -1
+        self.sort_order = QtCore.Qt.AscendingOrder
+        # proxy row -> source row, None when rows pass straight through
+        self.__rows = None
+        # source row -> proxy row, built when needed
+        self.__lookup = None
+        # key name or column -> list of values by source row
+        self.__keys = {}
+        # the last query and the rows it matched in source order
+        self.__last = (None, None)
+
+    def setSourceModel(self, model):
+        QtGui.QAbstractProxyModel.setSourceModel(self, model)
+        self.connect(model, QtCore.SIGNAL('rowsAboutToBeInserted(QModelIndex, int, int)'), self.__about_to_insert)
+        self.connect(model, QtCore.SIGNAL('rowsInserted(QModelIndex, int, int)'), self.__inserted)
+        self.connect(model, QtCore.SIGNAL('rowsAboutToBeRemoved(QModelIndex, int, int)'), self.__about_to_remove)
+        self.connect(model, QtCore.SIGNAL('rowsRemoved(QModelIndex, int, int)'), self.__removed)
+        self.connect(model, QtCore.SIGNAL('modelAboutToBeReset()'), self.beginResetModel)
+        self.connect(model, QtCore.SIGNAL('modelReset()'), self.__reset)
+        self.connect(model, QtCore.SIGNAL('dataChanged(QModelIndex, QModelIndex)'), self.__data_changed)
+
+    # model methods
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self.__rows is None:
+            return self.sourceModel().rowCount()
+        return len(self.__rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return self.sourceModel().columnCount()
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        # columns aren't filtered, and going through index(0, section) like
+        # the base class would fails when no rows are showing
+        if orientation == QtCore.Qt.Horizontal:
+            return self.sourceModel().headerData(section, orientation, role)
+        return QtGui.QAbstractProxyModel.headerData(self, section, orientation, role)
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if parent.isValid() or row < 0 or row >= self.rowCount() or column < 0 or column >= self.columnCount():
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=None):
+        if index is None:
+            # QObject.parent
+            return QtGui.QAbstractProxyModel.parent(self)
+        return QtCore.QModelIndex()
+
+    def mapToSource(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        return self.sourceModel().index(self.source_row(index.row()), index.column())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        if self.__rows is None:
+            return self.index(index.row(), index.column())
+        if self.__lookup is None:
+            self.__lookup = dict(zip(self.__rows, xrange(len(self.__rows))))
+        row = self.__lookup.get(index.row())
+        if row is None:
+            return QtCore.QModelIndex()
+        return self.index(row, index.column())
+
+    def source_row(self, row):
+        """source row shown at row"""
+        if self.__rows is None:
+            return row
+        return self.__rows[row]
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        """sort by column, or back to queue order for -1"""
+        self.sort_column = column
+        self.sort_order = order
+        self.__relayout(self.__arrange(self.__matching()))
+
+    # drops go to the queue
+    def supportedDropActions(self):
+        return self.sourceModel().supportedDropActions()
+
+    def mimeTypes(self):
+        return self.sourceModel().mimeTypes()
+
+    def dropMimeData(self, data, action, row, column, parent):
+        return self.sourceModel().dropMimeData(data, action, -1, -1, QtCore.QModelIndex())
+
+    # filtering
+    def set_filter(self, text):
+        """show only files matching text, see FileFilter"""
+        query = FileFilter(text)
+        self.beginResetModel()
+        self.query = query
+        self.__rows = self.__arrange(self.__matching())
+        self.__lookup = None
+        self.endResetModel()
+
+    def __matching(self, rows=None):
+        """
+        Source rows matching the query in source order, None for all of them.
+        Looks through rows if given, otherwise everything that could match.
+        """
+        query = self.query
+        if query.empty():
+            self.__last = (None, None)
+            return rows
+        remember = rows is None
+        if remember:
+            if query.narrows(self.__last[0]):
+                rows = self.__last[1]
+            else:
+                rows = xrange(self.sourceModel().rowCount())
+        if query.links:
+            wanted = self.__wanted('link', lambda name: [term for term in query.links if term in name])
+            rows = [row for row in rows if row in wanted]
+        if query.types:
+            wanted = self.__wanted('type', lambda kind: [term for term in query.types if term in kind])
+            rows = [row for row in rows if row in wanted]
+        if query.min_size is not None or query.max_size is not None:
+            sizes = self.__key('size')
+            (low, high) = (query.min_size, query.max_size)
+            if low is not None:
+                rows = [row for row in rows if sizes[row] > low]
+            if high is not None:
+                rows = [row for row in rows if sizes[row] < high]
+        paths = self.__key('path')
+        for word in query.words:
+            rows = [row for row in rows if word in paths[row]]
+        rows = list(rows)
+        if remember:
+            self.__last = (query, rows)
+        return rows
+
+    def __wanted(self, key, matches):
+        """set of source rows whose index entry for key matches"""
+        wanted = set()
+        for (name, rows) in self.__key(key).iteritems():
+            if matches(name):
+                wanted.update(rows)
+        return wanted
+
+    def __arrange(self, rows):
+        """put matching rows in sort order, None if there's nothing to do"""
+        if self.sort_column < 0:
+            return rows is not None and list(rows) or None
+        if rows is None:
+            rows = xrange(self.sourceModel().rowCount())
+        return sorted(rows, key=self.__key(self.sort_column).__getitem__,
+            reverse=(self.sort_order == QtCore.Qt.DescendingOrder))
+
+    def __key(self, key):
+        """values by source row to filter or sort on, or an index for link and type"""
+        if key in self.__keys:
+            return self.__keys[key]
+        files = self.sourceModel().files
+        if key in ('link', 'type'):
+            values = {}
+            self.__index(values, key, files, 0)
+        else:
+            values = map(self.__value(key), files)
+        self.__keys[key] = values
+        return values
+
+    def __value(self, key):
+        """function of a file giving its value for key, for the keys kept by row"""
+        if key == 'size':
+            return lambda f: f.size
+        if key == 'path':
+            return lambda f: lowered(f.path)
+        attr = self.sourceModel().column_attr(key)
+        if attr == 'hero_offset':
+            # numerically, blank offsets first
+            def offset(f):
+                try:
+                    return float(f.hero_offset)
+                except (TypeError, ValueError):
+                    return -1.0
+            return offset
+        return lambda f: lowered(getattr(f, attr, None) or '')
+
+    def __index(self, index, key, files, start):
+        """add files, the first of them at source row start, to the link or type index"""
+        if key == 'link':
+            for (row, f) in enumerate(files):
+                index.setdefault(lowered(f.link_name or ''), []).append(start + row)
+            return
+        # by extension, then each extension under everything it can be called
+        extensions = {}
+        for (row, f) in enumerate(files):
+            extensions.setdefault(os.path.splitext(f.path)[1].lower(), []).append(start + row)
+        for (ext, rows) in extensions.iteritems():
+            mime = mimetypes.guess_type('x' + ext)[0] or ''
+            kind = ' '.join([ext.lstrip('.'), mime, mime.split('/')[0]])
+            index.setdefault(kind, []).extend(rows)
+
+    def __splice_keys(self, first, last, inserted):
+        """move the values pulled out by row along with rows inserted or removed in the source"""
+        count = last - first + 1
+        for (key, values) in self.__keys.items():
+            if isinstance(values, dict):
+                for (name, rows) in values.items():
+                    if inserted:
+                        rows[:] = [row + (row >= first and count) for row in rows]
+                    else:
+                        rows[:] = [row - (row > last and count) for row in rows if row < first or row > last]
+                        if not rows:
+                            del values[name]
+                if inserted:
+                    self.__index(values, key, self.sourceModel().files[first:last+1], first)
+            elif inserted:
+                values[first:first] = map(self.__value(key), self.sourceModel().files[first:last+1])
+            else:
+                del values[first:last+1]
+        # new rows may match a query the last rows were narrowed from
+        self.__last = (None, None)
+        self.__lookup = None
+
+    def __relayout(self, rows):
+        """move to new rows, the same ones in a new order, keeping selections"""
+        self.emit(QtCore.SIGNAL('layoutAboutToBeChanged()'))
+        persistent = self.persistentIndexList()
+        sources = [self.mapToSource(index) for index in persistent]
+        self.__rows = rows
+        self.__lookup = None
+        self.changePersistentIndexList(persistent, [self.mapFromSource(index) for index in sources])
+        self.emit(QtCore.SIGNAL('layoutChanged()'))
+
+    # keeping up with the source
+    def __about_to_insert(self, parent, first, last):
+        if self.__rows is None:
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+
+    def __inserted(self, parent, first, last):
+        self.__splice_keys(first, last, True)
+        if self.__rows is None:
+            self.endInsertRows()
+            return
+        count = last - first + 1
+        rows = [row + (row >= first and count) for row in self.__rows]
+        self.__rows = rows
+        # the new rows that match go on the end, then get put in order
+        added = self.__matching(range(first, last + 1))
+        if added:
+            self.beginInsertRows(QtCore.QModelIndex(), len(rows), len(rows) + len(added) - 1)
+            self.__rows = rows + added
+            self.__lookup = None
+            self.endInsertRows()
+        if self.sort_column < 0:
+            self.__relayout(sorted(self.__rows))
+        else:
+            self.__relayout(self.__arrange(list(self.__rows)))
+
+    def __about_to_remove(self, parent, first, last):
+        if self.__rows is None:
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            return
+        # gone from the source, gone from here, a run of proxy rows at a time
+        # starting from the end so the rest stay put
+        if self.__lookup is None:
+            self.__lookup = dict(zip(self.__rows, xrange(len(self.__rows))))
+        gone = sorted([self.__lookup[row] for row in xrange(first, last + 1) if row in self.__lookup])
+        for (start, end) in reversed(row_runs(gone)):
+            self.beginRemoveRows(QtCore.QModelIndex(), start, end)
+            del self.__rows[start:end+1]
+            self.__lookup = None
+            self.endRemoveRows()
+
+    def __removed(self, parent, first, last):
+        self.__splice_keys(first, last, False)
+        if self.__rows is None:
+            self.endRemoveRows()
+            return
+        # what's left past the hole moves up
+        count = last - first + 1
+        self.__rows = [row - (row > last and count) for row in self.__rows]
+
+    def __reset(self):
+        # everything pulled out by row is stale
+        self.__keys = {}
+        self.__last = (None, None)
+        self.__lookup = None
+        self.__rows = self.__arrange(self.__matching())
+        self.endResetModel()
+
+    def __data_changed(self, top_left, bottom_right):
+        # edits don't move rows, but sort keys for the column are stale
+        for column in xrange(top_left.column(), bottom_right.column() + 1):
+            self.__keys.pop(column, None)
+        if self.__rows is None:
+            self.emit(QtCore.SIGNAL('dataChanged(QModelIndex, QModelIndex)'),
+                self.mapFromSource(top_left), self.mapFromSource(bottom_right))
+        elif self.__rows:
+            # could be scattered anywhere, let the view sort out what is on screen
+            self.emit(QtCore.SIGNAL('dataChanged(QModelIndex, QModelIndex)'),
+                self.index(0, top_left.column()), self.index(len(self.__rows) - 1, bottom_right.column()))
+
+################################################################################
+# File Object
+################################################################################
+class ShotgunFile(object):
+    """wrapper around info needed to upload a file"""
+    def __init__(self, path, tags, link, hero_offset=None, note='', upload_path=None):
+        self.path = path
+        # what actually gets sent, path is what gets recorded
+        self.upload_path = upload_path or path
+        self.tags = tags
+        self.hero_offset = ''
+        self.link = link
+        self.note = note
+        self.link_name = link.get('name', link.get('code', ''))
+        if hero_offset is None:
+            # default offset to 1 for video mime-types
+            mime_guess = mimetypes.guess_type(path)[0]
+            if mime_guess is not None and mime_guess.startswith('video'):
+                self.hero_offset = '1'
+        self.size = os.path.getsize(self.upload_path)
+
+    def display_path(self):
+        return self.path
+    display_path = property(display_path)
+
+    def to_dict(self):
+        """plain data for the spool, file_from_dict turns it back into a file"""
+        return {'path': self.path, 'upload_path': self.upload_path, 'tags': self.tags,
+            'link': self.link, 'hero_offset': self.hero_offset, 'note': self.note, 'size': self.size}
+
+################################################################################
+class ShotgunSequence(ShotgunFile):
+    """a run of frames uploaded as a single representative frame"""
+    def __init__(self, sequence, tags, link, note=''):
+        self.sequence = sequence
+        ShotgunFile.__init__(self, sequence.pattern, tags, link, note=note, upload_path=sequence.representative)
+
+    def display_path(self):
+        text = '%s [%s]' % (self.path, self.sequence.frame_range)
+        missing = self.sequence.missing()
+        if missing:
+            text += ' (%d missing)' % len(missing)
+        return text
+    display_path = property(display_path)
+
+    def to_dict(self):
+        data = ShotgunFile.to_dict(self)
+        data['sequence'] = {'head': self.sequence.head, 'tail': self.sequence.tail,
+            'padding': self.sequence.padding, 'frames': self.sequence.frames}
+        return data
+
+def file_from_dict(data):
+    """rebuild a file from ShotgunFile.to_dict without going back to disk"""
+    if 'sequence' in data:
+        f = ShotgunSequence.__new__(ShotgunSequence)
+        seq = data['sequence']
+        f.sequence = FrameSequence(str(seq['head']), str(seq['tail']), seq['padding'])
+        f.sequence.frames = [(n, str(path)) for (n, path) in seq['frames']]
+    else:
+        f = ShotgunFile.__new__(ShotgunFile)
+    f.path = str(data['path'])
+    f.upload_path = str(data['upload_path'])
+    f.tags = data['tags']
+    f.link = data['link']
+    f.hero_offset = data['hero_offset']
+    f.note = data['note']
+    f.size = data['size']
+    f.link_name = f.link.get('name', f.link.get('code', ''))
+    return f
+
+################################################################################
+class BulkEditCommand(QtGui.QUndoCommand):
+    """
+    Set one column of many rows as a single undo step.  The pattern is the new
+    value, with $value standing in for each row's current one, so '$value,wip'
+    adds a tag to every row.  Rows where the column can't be edited (hero frames
+    of stills) are left alone.
+    """
+    def __init__(self, model, rows, column, pattern, text='bulk edit', parent=None):
+        QtGui.QUndoCommand.__init__(self, text, parent)
+        self.model = model
+        self.column = column
+        self.old = {}
+        self.new = {}
+        for row in rows:
+            if not model.flags(model.index(row, column)) & QtCore.Qt.ItemIsEditable:
+                continue
+            old = str(model.data(model.index(row, column)).toString())
+            new = bulk_value(pattern, old)
+            if new != old:
+                self.old[row] = old
+                self.new[row] = new
+
+    def redo(self):
+        self.model._update_rows(self.column, self.new)
+
+    def undo(self):
+        self.model._update_rows(self.column, self.old)
+
+def bulk_value(pattern, old):
+    """
+    pattern with $value replaced by old.  When there was no old value, the
+    separators that were joining it on are dropped, so '$value,wip' is 'wip'.
+    """
+    new = pattern.replace('$value', old)
+    if not old and '$value' in pattern:
+        new = new.strip(', \n')
+    return new
+
+class BulkEditDialog(QtGui.QDialog):
+    """pick a column and a value pattern to apply to the selected rows"""
+    def __init__(self, model, nrows, parent=None):
+        QtGui.QDialog.__init__(self, parent)
+        self.setWindowTitle('Bulk Edit %d Files' % nrows)
+        self.column = QtGui.QComboBox(self)
+        for (column, text) in model.editable_columns():
+            self.column.addItem(text, QtCore.QVariant(column))
+        self.pattern = QtGui.QLineEdit('$value', self)
+        self.pattern.selectAll()
+        help = QtGui.QLabel('$value is replaced by what each file has now,\n'
+            'so $value,wip adds a tag and an empty value clears it.', self)
+        buttons = QtGui.QDialogButtonBox(QtGui.QDialogButtonBox.Ok|QtGui.QDialogButtonBox.Cancel, QtCore.Qt.Horizontal, self)
+        layout = QtGui.QFormLayout(self)
+        layout.addRow('Column', self.column)
+        layout.addRow('Value', self.pattern)
+        layout.addRow(help)
+        layout.addRow(buttons)
+        self.connect(buttons, QtCore.SIGNAL('accepted()'), self.accept)
+        self.connect(buttons, QtCore.SIGNAL('rejected()'), self.reject)
+
+    def selected_column(self):
+        return self.column.itemData(self.column.currentIndex()).toInt()[0]
+
+################################################################################
+# Sequences
+################################################################################
+# frame number between a . or _ and the extension: name.1001.exr, name_1001.exr
+FRAME_RE = re.compile(r'^(?P<head>.*?[._])(?P<frame>\d+)(?P<tail>\.[^.%s]+)$' % re.escape(os.sep))
+
+class FrameSequence(object):
+    """numbered frames sharing a name and extension"""
+    def __init__(self, head, tail, padding):
+        self.head = head
+        self.tail = tail
+        self.padding = padding
+        # (frame number, path)
+        self.frames = []
+
+    def pattern(self):
+        """shot_010.####.exr style name for the whole run"""
+        return '%s%s%s' % (self.head, '#' * self.padding, self.tail)
+    pattern = property(pattern)
+
+    def printf_pattern(self):
+        """shot_010.%04d.exr style name, what ffmpeg wants"""
+        return '%s%%0%dd%s' % (self.head.replace('%', '%%'), self.padding, self.tail.replace('%', '%%'))
+    printf_pattern = property(printf_pattern)
+
+    def first(self):
+        return self.frames[0][0]
+    first = property(first)
+
+    def last(self):
+        return self.frames[-1][0]
+    last = property(last)
+
+    def representative(self):
+        """path of the middle frame, sent in place of the whole run"""
+        return self.frames[len(self.frames)/2][1]
+    representative = property(representative)
+
+    def frame_range(self):
+        return '%d-%d' % (self.first, self.last)
+    frame_range = property(frame_range)
+
+    def missing(self):
+        """frame numbers missing between the first and last frame"""
+        have = set([n for (n, path) in self.frames])
+        return [n for n in xrange(self.first, self.last+1) if n not in have]
+
+    def missing_text(self):
+        """missing frames as compact ranges, '1050, 1060-1062'"""
+        ranges = []
+        for n in self.missing():
+            if ranges and ranges[-1][1] == n-1:
+                ranges[-1][1] = n
+            else:
+                ranges.append([n, n])
+        return ', '.join([a == b and str(a) or '%d-%d' % (a, b) for (a, b) in ranges])
+
+def frame_padding(frame):
+    """width a frame number is padded to, 1 if it isn't zero padded"""
+    if len(frame) > 1 and frame[0] == '0':
+        return len(frame)
+    return 1
+
+def find_sequences(paths, min_frames=MIN_SEQUENCE_FRAMES):
+    """
+    Collapse numbered image frames in paths into FrameSequences.
+
+    Returns a list in the order things were first seen where each item is
+    either a path or a FrameSequence.  Zero padded frames go by their width.
+    Unpadded ones (998, 1001) join a padded run as wide as they are, so
+    0998-1001 is one #### run, and otherwise make a # run of their own, so
+    998-1001 is too.  Nothing touches the filesystem.
+    """
+    stills = {}
+    # (head, tail) -> [(frame, path)]
+    runs = {}
+    order = []
+    for path in paths:
+        m = frame_match(path, stills)
+        if m is None:
+            order.append(path)
+            continue
+        key = (m.group('head'), m.group('tail'))
+        frames = runs.get(key)
+        if frames is None:
+            frames = runs[key] = []
+            order.append(key)
+        frames.append((m.group('frame'), path))
+    items = []
+    for item in order:
+        if not isinstance(item, tuple):
+            items.append(item)
+            continue
+        frames = runs[item]
+        widths = set([len(frame) for (frame, path) in frames if frame_padding(frame) > 1])
+        sequences = {}
+        for (frame, path) in frames:
+            padding = frame_padding(frame)
+            if padding == 1 and len(frame) in widths:
+                padding = len(frame)
+            if padding not in sequences:
+                sequences[padding] = FrameSequence(item[0], item[1], padding)
+            sequences[padding].frames.append((int(frame), path))
+        for padding in sorted(sequences):
+            sequence = sequences[padding]
+            if len(sequence.frames) < min_frames:
+                # too short to bother, back to plain files
+                items.extend([path for (n, path) in sequence.frames])
+                continue
+            sequence.frames.sort()
+            items.append(sequence)
+    return items
+
+################################################################################
+# Commands
+################################################################################
+class ChangeValueCommand(QtGui.QUndoCommand):
+    def __init__(self, index, value, model, text='value change', parent=None):
+        QtGui.QUndoCommand.__init__(self, text, parent)
+        self.__old = index.data(QtCore.Qt.DisplayRole).toString()
+        self.__new = value.toString()
+        self.__row = index.row()
+        self.__col = index.column()
+        self.__model = model
+
+    def redo(self):
+        self.__model._update_data(self.__row, self.__col, self.__new)
+
+    def undo(self):
+        self.__model._update_data(self.__row, self.__col, self.__old)
+
+################################################################################
+class NewFileCommand(QtGui.QUndoCommand):
+    def __init__(self, model, files, text='new files', parent=None, drop=None):
+        QtGui.QUndoCommand.__init__(self, text, parent)
+        self.model = model
+        self.files = files
+        # batches of one drop merge into a single undo step
+        self.drop = drop
+
+    def id(self):
+        if self.drop is None:
+            return -1
+        return 1
+
+    def mergeWith(self, other):
+        if other.drop != self.drop or other.first != self.last:
+            return False
+        self.files = self.files + other.files
+        self.last = other.last
+        return True
+
+    def redo(self):
+        self.first = self.model.rowCount()
+        self.model.append_files(self.files)
+        self.last = self.model.rowCount()
+
+    def undo(self):
+        self.model.delete_files(self.first, self.last)
+
+################################################################################
+class DeleteFilesCommand(QtGui.QUndoCommand):
+    def __init__(self, model, rows, text='delete files', parent=None):
+        QtGui.QUndoCommand.__init__(self, text, parent)
+        self.model = model
+        self.files = dict([(row, model.files[row]) for row in rows])
+
+    def redo(self):
+        # make sure we do this in reverse order so rows stay accurate while
+        # deleting, a run of rows at a time
+        for (first, last) in reversed(row_runs(sorted(self.files.keys()))):
+            self.model.delete_files(first, last+1)
+
+    def undo(self):
+        # make sure we do this in row order to keep things as they were
+        for (first, last) in row_runs(sorted(self.files.keys())):
+            self.model.insert_files([self.files[row] for row in xrange(first, last+1)], first)
+
+################################################################################
+# Thumbnails
+################################################################################
+class ThumbnailEngine(object):
+    """
+    Makes jpeg thumbnails for stills in process on a pool of worker threads.
+
+    Decoding is where the time goes for big images, so formats that can decode
+    at a reduced size (jpeg through draft mode) are decoded at the smallest
+    scale that still covers the thumbnail, 1/8 for a 6K jpeg.  Anything PIL
+    can't handle comes back as None so the image command can have a go.
+    """
+    def __init__(self, workers=DEFAULT_THUMBNAIL_WORKERS, size=THUMBNAIL_SIZE):
+        self.size = size
+        self.__jobs = Queue.Queue()
+        self.__cond = threading.Condition()
+        # path -> jpeg data, or None for pending or failed
+        self.__results = {}
+        self.__pending = set()
+        if Image is None:
+            workers = 0
+        for i in xrange(workers):
+            worker = threading.Thread(target=self.__work, name='thumbnailer%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+
+    def available(self):
+        """can thumbnails be made in process at all"""
+        return Image is not None
+
+    def submit(self, path):
+        """queue up a thumbnail for path, doing nothing if it is already queued or done"""
+        if not self.available():
+            return
+        self.__cond.acquire()
+        try:
+            if path in self.__pending or path in self.__results:
+                return
+            self.__pending.add(path)
+        finally:
+            self.__cond.release()
+        self.__jobs.put(path)
+
+    def result(self, path):
+        """
+        Wait for and hand back the thumbnail for path as jpeg data.
+        Returns None if it couldn't be made in process.
+        """
+        self.submit(path)
+        self.__cond.acquire()
+        try:
+            while path in self.__pending:
+                self.__cond.wait()
+            # hand it over, no need to keep it around
+            return self.__results.pop(path, None)
+        finally:
+            self.__cond.release()
+
+    def __work(self):
+        while True:
+            path = self.__jobs.get()
+            try:
+                data = self.make_thumbnail(path)
+            except Exception:
+                # unsupported or broken, let the image command deal with it
+                data = None
+            self.__cond.acquire()
+            try:
+                self.__pending.discard(path)
+                self.__results[path] = data
+                self.__cond.notifyAll()
+            finally:
+                self.__cond.release()
+
+    def make_thumbnail(self, path):
+        """decode path as small as possible and return it as jpeg data"""
+        im = Image.open(path)
+        # only changes anything for formats that support reduced decoding,
+        # but there it means decoding 1/64th of the pixels
+        im.draft('RGB', self.size)
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        im.thumbnail(self.size, Image.ANTIALIAS)
+        out = cStringIO.StringIO()
+        im.save(out, 'JPEG', quality=85)
+        return out.getvalue()
+
+################################################################################
+class FilmstripCache(object):
+    """
+    Evenly spaced keyframes from movies, cached per file.
+
+    The frames come out of a single ffmpeg pass that only decodes keyframes, so
+    a filmstrip costs about as much as the one thumbnail the movie command would
+    make.  Frames are kept at thumbnail size so the one picked as the hero frame
+    can be uploaded as the thumbnail without running ffmpeg again.
+    """
+    __PTS_RE = re.compile(r'Parsed_showinfo.*\spts_time:\s*(?P<time>[-0-9.]+)')
+
+    def __init__(self, count=FILMSTRIP_FRAMES, size=THUMBNAIL_SIZE, max_files=FILMSTRIP_CACHE_SIZE):
+        self.count = count
+        self.size = size
+        self.max_files = max_files
+        self.__lock = threading.Lock()
+        # (path, mtime, size) -> [(seconds, jpeg data), ...], oldest first
+        self.__cache = {}
+        self.__order = []
+
+    def __key(self, path):
+        stat = os.stat(path)
+        return (path, stat.st_mtime, stat.st_size)
+
+    def cached(self, path):
+        """the frames for path if they've already been pulled, otherwise None"""
+        try:
+            key = self.__key(path)
+        except OSError:
+            return None
+        self.__lock.acquire()
+        try:
+            return self.__cache.get(key)
+        finally:
+            self.__lock.release()
+
+    def frames(self, path):
+        """list of (seconds, jpeg data) for path, running ffmpeg if they aren't cached"""
+        frames = self.cached(path)
+        if frames is not None:
+            return frames
+        key = self.__key(path)
+        frames = self.extract(path)
+        self.__lock.acquire()
+        try:
+            if key not in self.__cache:
+                self.__order.append(key)
+            self.__cache[key] = frames
+            while len(self.__order) > self.max_files:
+                del self.__cache[self.__order.pop(0)]
+        finally:
+            self.__lock.release()
+        return frames
+
+    def frame(self, path, offset):
+        """jpeg data for the cached frame at offset seconds, None if there isn't one"""
+        try:
+            offset = float(offset)
+        except ValueError:
+            return None
+        for (seconds, data) in self.cached(path) or []:
+            if abs(seconds - offset) < 0.0005:
+                return data
+        return None
+
+    def duration(self, path):
+        """length of the movie in seconds, only reads the header"""
+        proc = subprocess.Popen([FFPROBE, '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = proc.communicate()[0]
+        try:
+            return float(out.strip())
+        except ValueError:
+            return 0.0
+
+    def extract(self, path):
+        """pull self.count evenly spaced keyframes out of path in one pass"""
+        duration = self.duration(path)
+        if duration <= 0:
+            return []
+        interval = duration / self.count
+        # keep the first keyframe at least interval past the last one kept.
+        # showinfo logs the timestamp of each frame that makes it through
+        vf = "select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,%f)',scale=w=%d:h=%d:force_original_aspect_ratio=decrease,showinfo" % \
+            (interval, self.size[0], self.size[1])
+        proc = subprocess.Popen([FFMPEG, '-hide_banner', '-nostats', '-v', 'info', '-skip_frame', 'nokey',
+            '-i', path, '-an', '-vf', vf, '-vsync', 'vfr', '-f', 'image2pipe', '-vcodec', 'mjpeg',
+            '-q:v', '3', 'pipe:1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        times = [float(m.group('time')) for m in self.__PTS_RE.finditer(err)]
+        return zip(times, split_jpegs(out))[:self.count]
+
+def split_jpegs(data):
+    """split a stream of concatenated jpegs (ffmpeg image2pipe) into a list of them"""
+    jpegs = []
+    start = data.find('\xff\xd8')
+    while start != -1:
+        end = data.find('\xff\xd9', start)
+        if end == -1:
+            break
+        jpegs.append(data[start:end+2])
+        start = data.find('\xff\xd8', end+2)
+    return jpegs
+
+################################################################################
+class FilmstripThread(QtCore.QThread):
+    """pull a filmstrip in the background, emitting framesReady(PyQt_PyObject) when done"""
+    def __init__(self, cache, path, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.cache = cache
+        self.path = path
+
+    def run(self):
+        try:
+            frames = self.cache.frames(self.path)
+        except OSError:
+            # file went away or ffmpeg isn't around
+            frames = []
+        self.emit(QtCore.SIGNAL('framesReady(PyQt_PyObject)'), frames)
+
+class FilmstripDialog(QtGui.QDialog):
+    """pick a hero frame for a movie from a strip of its keyframes"""
+    def __init__(self, cache, path, offset='', parent=None):
+        QtGui.QDialog.__init__(self, parent)
+        self.setWindowTitle('Hero Frame: %s' % os.path.basename(path))
+        self.offset = offset
+        self.__times = []
+        self.thread = None
+        # strip of frames, left to right
+        self.strip = QtGui.QListWidget(self)
+        self.strip.setViewMode(QtGui.QListView.IconMode)
+        self.strip.setFlow(QtGui.QListView.LeftToRight)
+        self.strip.setWrapping(False)
+        self.strip.setMovement(QtGui.QListView.Static)
+        self.strip.setIconSize(QtCore.QSize(160, 120))
+        self.strip.setMinimumSize(QtCore.QSize(640, 180))
+        self.status = QtGui.QLabel('Pulling frames...', self)
+        buttons = QtGui.QDialogButtonBox(QtGui.QDialogButtonBox.Ok|QtGui.QDialogButtonBox.Cancel, QtCore.Qt.Horizontal, self)
+        layout = QtGui.QVBoxLayout(self)
+        layout.addWidget(self.strip)
+        layout.addWidget(self.status)
+        layout.addWidget(buttons)
+        self.connect(buttons, QtCore.SIGNAL('accepted()'), self.accept)
+        self.connect(buttons, QtCore.SIGNAL('rejected()'), self.reject)
+        self.connect(self.strip, QtCore.SIGNAL('itemDoubleClicked(QListWidgetItem *)'), self.accept)
+        # cached strips show up right away, otherwise go get them
+        frames = cache.cached(path)
+        if frames is not None:
+            self.frames_ready(frames)
+        else:
+            self.thread = FilmstripThread(cache, path, self)
+            self.connect(self.thread, QtCore.SIGNAL('framesReady(PyQt_PyObject)'), self.frames_ready)
+            self.thread.start()
+
+    def frames_ready(self, frames):
+        if not frames:
+            self.status.setText("Couldn't pull any frames.  Is %s in your PATH?" % FFMPEG)
+            return
+        self.status.setText('Double click a frame to use it as the hero frame.')
+        for (seconds, data) in frames:
+            pixmap = QtGui.QPixmap()
+            pixmap.loadFromData(data, 'JPEG')
+            text = ('%.3f' % seconds).rstrip('0').rstrip('.')
+            self.strip.addItem(QtGui.QListWidgetItem(QtGui.QIcon(pixmap), text))
+            self.__times.append(text)
+            if text == self.offset:
+                self.strip.setCurrentRow(self.strip.count()-1)
+
+    def accept(self, item=None):
+        row = self.strip.currentRow()
+        if row >= 0:
+            self.offset = self.__times[row]
+        QtGui.QDialog.accept(self)
+
+    def dispose(self):
+        """
+        Delete the dialog once it's been answered.  A strip still being pulled
+        is left to finish under the dialog's parent, so its frames still make
+        it into the cache, and is deleted when it's done.
+        """
+        thread = self.thread
+        if thread is not None:
+            self.disconnect(thread, QtCore.SIGNAL('framesReady(PyQt_PyObject)'), self.frames_ready)
+            thread.setParent(self.parent())
+            thread.connect(thread, QtCore.SIGNAL('finished()'), thread.deleteLater)
+            if thread.isFinished():
+                thread.deleteLater()
+            self.thread = None
+        self.deleteLater()
+
+################################################################################
+# Proxies
+################################################################################
+def parse_proxy_rules(text):
+    """
+    Turn proxy rule lines into a list of (media type, options).
+
+    Each line is 'MEDIA_TYPE: key=value ...' where MEDIA_TYPE is a mime type
+    (image/tiff) or just the first half of one (image).  Options are max=WxH,
+    codec, quality and ext.  Raises ValueError on lines that don't parse.
+    """
+    rules = []
+    for line in [line.strip() for line in text.split('\n') if line.strip()]:
+        (media, options) = [s.strip() for s in line.split(':', 1)]
+        rule = {}
+        for option in options.split():
+            (key, value) = option.split('=', 1)
+            rule[key] = value
+        if 'max' in rule:
+            rule['max'] = tuple([int(n) for n in rule['max'].lower().split('x', 1)])
+            if len(rule['max']) != 2:
+                raise ValueError("max should be WIDTHxHEIGHT: %s" % line)
+        rules.append((media, rule))
+    return rules
+
+def proxy_rule(rules, mime):
+    """options of the rule that best matches mime, a full mime type beats a half one"""
+    if mime is None:
+        return None
+    for (media, rule) in rules:
+        if media == mime:
+            return rule
+    for (media, rule) in rules:
+        if media == mime.split('/')[0]:
+            return rule
+    return None
+
+def make_proxy(args):
+    """
+    Make a proxy of path following rule, writing it into directory.
+    Returns the proxy path, or None if there is no point uploading it.
+    Runs in the proxy worker processes, so takes a single picklable tuple.
+    """
+    (path, mime, rule, directory) = args
+    (width, height) = rule.get('max', (4096, 4096))
+    quality = int(rule.get('quality', mime.startswith('video') and 23 or 85))
+    base = os.path.join(directory, os.path.splitext(os.path.basename(path))[0])
+    if mime.startswith('video'):
+        out = base + rule.get('ext', '.mov')
+        cmd = [FFMPEG, '-y', '-v', 'error', '-i', path,
+            '-vf', 'scale=w=%d:h=%d:force_original_aspect_ratio=decrease,pad=ceil(iw/2)*2:ceil(ih/2)*2' % \
+                (width, height),
+            '-c:v', rule.get('codec', 'libx264'), '-crf', str(quality), '-pix_fmt', 'yuv420p', '-c:a', 'aac', out]
+    else:
+        out = base + rule.get('ext', '.jpg')
+        cmd = []
+        if Image is not None:
+            try:
+                im = Image.open(path)
+                im.draft('RGB', (width, height))
+                if im.mode != 'RGB':
+                    im = im.convert('RGB')
+                im.thumbnail((width, height), Image.ANTIALIAS)
+                im.save(out, rule.get('codec', 'jpeg').upper(), quality=quality)
+                cmd = None
+            except Exception:
+                # dpx and friends, let ffmpeg have a go
+                pass
+        if cmd is not None:
+            # ffmpeg takes its jpeg quality as 2 (best) to 31
+            qscale = 2 + (100 - min(quality, 100)) * 29 / 100
+            cmd = [FFMPEG, '-y', '-v', 'error', '-i', path,
+                '-vf', "scale=w='min(%d,iw)':h='min(%d,ih)':force_original_aspect_ratio=decrease" % (width, height),
+                '-frames:v', '1', '-q:v', str(qscale), out]
+    if cmd:
+        try:
+            subprocess.call(cmd)
+        except OSError:
+            # no ffmpeg
+            return None
+    if not os.path.exists(out):
+        return None
+    if os.path.getsize(out) >= os.path.getsize(path):
+        # bigger than what we started with, just send the original
+        os.remove(out)
+        return None
+    return out
+
+class ProxyStage(object):
+    """
+    Makes smaller review copies of files ahead of the upload.
+
+    Proxies are made on a pool of processes as soon as files are submitted, so
+    they're usually ready by the time the upload gets to them.  Files with no
+    matching rule, or whose proxy came out no smaller, are sent as they are.
+    """
+    def __init__(self, rules, workers=DEFAULT_PROXY_WORKERS):
+        self.rules = rules
+        self.directory = tempfile.mkdtemp(prefix='uploader_proxies_')
+        self.__results = {}
+        self.__pool = None
+        if multiprocessing is not None:
+            self.__pool = multiprocessing.Pool(workers)
+
+    def submit(self, path):
+        """start on a proxy for path if there is a rule for it"""
+        if path in self.__results:
+            return
+        mime = mimetypes.guess_type(path)[0]
+        rule = proxy_rule(self.rules, mime)
+        if rule is None:
+            self.__results[path] = None
+            return
+        # a directory each so proxies of same named files don't collide
+        args = (path, mime, rule, tempfile.mkdtemp(dir=self.directory))
+        if self.__pool is not None:
+            self.__results[path] = self.__pool.apply_async(make_proxy, (args,))
+        else:
+            self.__results[path] = args
+
+    def result(self, path):
+        """wait for and return the proxy for path, or None to send the original"""
+        result = self.__results.pop(path, None)
+        if result is None:
+            return None
+        if isinstance(result, tuple):
+            return make_proxy(result)
+        try:
+            return result.get()
+        except Exception:
+            return None
+
+    def close(self):
+        """stop the workers and throw away any proxies left over"""
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool.join()
+        shutil.rmtree(self.directory, True)
+
+################################################################################
+# Link Search
+################################################################################
+def trigrams(text):
+    """set of the three character runs in text"""
+    return set([text[i:i+3] for i in xrange(len(text)-2)])
+
+class SearchIndex(object):
+    """
+    Case insensitive index of names for ranked lookups as you type.
+
+    Names are added a batch at a time and each gets an id, its position in
+    texts.  Prefix matches come from sorted lists, substring and fuzzy matches
+    from trigram postings, so nothing ever scans every name.
+    """
+    __WORD_RE = re.compile(r'[^a-z0-9]+')
+    # share of a query's trigrams a name needs to count as a fuzzy match
+    FUZZY = 0.5
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # id -> text and data
+        self.texts = []
+        self.data = []
+        self.__lower = []
+        # lower text -> ids with it, names aren't unique
+        self.__exact = {}
+        # (lower text, id) and (lower word, id), kept sorted for prefix lookups
+        self.__names = []
+        self.__words = []
+        # trigram -> set of ids
+        self.__grams = {}
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, entries):
+        """add a batch of (text, data)"""
+        (names, words) = ([], [])
+        for (text, data) in entries:
+            n = len(self.texts)
+            lower = text.lower()
+            self.texts.append(text)
+            self.data.append(data)
+            self.__lower.append(lower)
+            self.__exact.setdefault(lower, []).append(n)
+            names.append((lower, n))
+            # the first word is covered by the name itself
+            for word in self.__WORD_RE.split(lower)[1:]:
+                if word:
+                    words.append((word, n))
+            for gram in trigrams(lower):
+                self.__grams.setdefault(gram, set()).add(n)
+        # sorting an already sorted list plus a sorted run is just a merge
+        names.sort()
+        words.sort()
+        self.__names.extend(names)
+        self.__names.sort()
+        self.__words.extend(words)
+        self.__words.sort()
+
+    def contains(self, text):
+        return text.lower() in self.__exact
+
+    def ids(self, text):
+        """
+        Ids of the names that are text, ignoring case unless some match it
+        exactly.  More than one means text alone can't say which is meant.
+        """
+        ids = self.__exact.get(text.lower(), [])
+        exact = [n for n in ids if self.texts[n] == text]
+        return exact or ids[:]
+
+    def __prefixed(self, pairs, prefix, limit):
+        ids = []
+        i = bisect.bisect_left(pairs, (prefix,))
+        while i < len(pairs) and len(ids) < limit and pairs[i][0].startswith(prefix):
+            ids.append(pairs[i][1])
+            i += 1
+        return ids
+
+    def search(self, query, limit=LINK_SEARCH_LIMIT):
+        """
+        Ids of the best matches for query, best first.
+        Exact matches beat prefixes, which beat word prefixes, then
+        substrings, then names sharing most of the query's trigrams.
+        """
+        q = query.lower().strip()
+        if not q:
+            return range(min(limit, len(self.texts)))
+        ranked = []
+        seen = set()
+        def take(rank, ids, score=0):
+            for n in ids:
+                if n not in seen:
+                    seen.add(n)
+                    ranked.append((rank, -score, len(self.__lower[n]), n))
+        if q in self.__exact:
+            take(0, self.__exact[q])
+        take(1, self.__prefixed(self.__names, q, limit))
+        take(2, self.__prefixed(self.__words, q, limit))
+        grams = trigrams(q)
+        if len(ranked) < limit and grams:
+            postings = sorted([self.__grams.get(gram, set()) for gram in grams], key=len)
+            if postings[0]:
+                # only names with every trigram can hold the query
+                candidates = reduce(lambda a, b: a & b, postings[1:], postings[0])
+                take(3, [n for n in candidates if q in self.__lower[n]])
+            if len(ranked) < limit:
+                counts = {}
+                for posting in postings:
+                    for n in posting:
+                        counts[n] = counts.get(n, 0) + 1
+                need = max(1, int(len(grams) * self.FUZZY))
+                for (n, count) in counts.iteritems():
+                    if count >= need:
+                        take(4, [n], count)
+        ranked.sort()
+        return [n for (rank, score, length, n) in ranked[:limit]]
+
+################################################################################
+class LinkNameModel(QtCore.QAbstractListModel):
+    """
+    Names in a SearchIndex for a combo box or completer.
+
+    Views get the names LINK_FETCH_SIZE at a time as they scroll, rather than
+    all at once.  With a query set, only the best matches for it are shown.
+    """
+    def __init__(self, index, parent=None):
+        super(LinkNameModel, self).__init__(parent)
+        self.index = index
+        self.query = ''
+        # ids of the matches for query, None for everything in the index
+        self.__ids = None
+        self.__loaded = 0
+
+    def __total(self):
+        if self.__ids is None:
+            return len(self.index)
+        return len(self.__ids)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.__loaded
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.__loaded < self.__total()
+
+    def fetchMore(self, parent):
+        count = min(LINK_FETCH_SIZE, self.__total() - self.__loaded)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self.__loaded, self.__loaded+count-1)
+        self.__loaded += count
+        self.endInsertRows()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.__loaded:
+            return QtCore.QVariant()
+        n = index.row()
+        if self.__ids is not None:
+            n = self.__ids[n]
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return QtCore.QVariant(self.index.texts[n])
+        if role == QtCore.Qt.UserRole:
+            return QtCore.QVariant(self.index.data[n])
+        return QtCore.QVariant()
+
+    def set_query(self, query):
+        """show the matches for query, everything if it is empty"""
+        self.query = query
+        if query:
+            self.__ids = self.index.search(query)
+        else:
+            self.__ids = None
+        self.__loaded = min(LINK_FETCH_SIZE, self.__total())
+        self.reset()
+
+    def refresh(self):
+        """the index changed, start over"""
+        self.set_query(self.query)
+
+    def names_added(self):
+        """the index grew, pick up the new names without resetting the view"""
+        if self.__ids is None:
+            # the rest come along as the view scrolls
+            self.fetchMore(QtCore.QModelIndex())
+        else:
+            self.refresh()
+
+class LinkQueryThread(QtCore.QThread):
+    """
+    Load the names of all entities of a link type in the background.
+
+    Entities come from shotgun a page at a time and each page is emitted as
+    pageLoaded(PyQt_PyObject), a list of (name, id), as soon as it arrives.
+    cancel() makes it stop before asking for another page.  If shotgun
+    couldn't be asked, failed holds the reason once it has finished.
+    """
+    FIELDS = ['display_name', 'content', 'name', 'code', 'sg_sequence', 'sg_asset_type']
+
+    def __init__(self, conn, link_type, filters, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.conn = conn
+        self.link_type = link_type
+        self.filters = filters
+        self.cancelled = False
+        self.failed = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        seq_map = None
+        page = 1
+        try:
+            while not self.cancelled:
+                # order by id so pages don't shift under us
+                matches = self.conn.find(self.link_type, self.filters, self.FIELDS,
+                    order=[{'field_name': 'id', 'direction': 'asc'}], limit=LINK_PAGE_SIZE, page=page)
+                if matches and seq_map is None and matches[0].has_key('sg_sequence'):
+                    # going to need sequences
+                    seqs = self.conn.find('Sequence', self.filters, ['code'])
+                    seq_map = dict([(s['id'], s['code']) for s in seqs])
+                entries = []
+                for match in matches:
+                    text = link_text(match, seq_map)
+                    if text is None:
+                        # the entity type has no field we know about as a
+                        # useful name, no point going on
+                        self.cancelled = True
+                        break
+                    entries.append((text, match['id']))
+                if entries and not self.cancelled:
+                    self.emit(QtCore.SIGNAL('pageLoaded(PyQt_PyObject)'), entries)
+                if len(matches) < LINK_PAGE_SIZE:
+                    break
+                page += 1
+        except Exception, e:
+            # shotgun faults and network trouble, let the ui say something
+            self.failed = str(e)
+
+def link_text(match, seq_map=None):
+    """pretty name for an entity found by LinkQueryThread, None if it has nothing name like"""
+    # TODO: make the set of extra info included with a name richer
+    # look for something that has a good name
+    text = match.get('display_name', match.get('content', match.get('name', match.get('code', None))))
+    if text is None:
+        return None
+    if match.has_key('sg_sequence'):
+        # display the sequence if we've got it
+        text = text + " (%s)" % (match['sg_sequence'] and (seq_map or {}).get(match['sg_sequence']['id']) or 'None')
+    elif match.has_key('sg_asset_type'):
+        # display the asset type if we've got it
+        text = text + " (%s)" % match['sg_asset_type']
+    return text
+
+class MembershipValidator(QtGui.QValidator):
+    """accept names in a SearchIndex, allow typing anything that still matches one"""
+    def __init__(self, index, parent=None):
+        QtGui.QValidator.__init__(self, parent)
+        self.index = index
+
+    def validate(self, text, pos):
+        text = unicode(text)
+        if self.index.contains(text):
+            return (QtGui.QValidator.Acceptable, pos)
+        if self.index.search(text, 1):
+            return (QtGui.QValidator.Intermediate, pos)
+        return (QtGui.QValidator.Invalid, pos)
+
+################################################################################
+# Progress
+################################################################################
+def format_duration(seconds):
+    """seconds as H:MM:SS"""
+    seconds = int(seconds + 0.5)
+    return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+def format_rate(rate):
+    """bytes per second as something readable"""
+    for unit in ['B', 'KB', 'MB']:
+        if rate < 1024:
+            return '%.1f %s/s' % (rate, unit)
+        rate /= 1024.0
+    return '%.1f GB/s' % rate
+
+class ThroughputEstimator(object):
+    """
+    Upload rate and time left, worked out from what has gone by so far.
+
+    The rate is a moving average of bytes per second where samples lose half
+    their weight every RATE_HALF_LIFE seconds, so one big file counts as much
+    as the same time spent on many small ones.  A sample more than twice as
+    fast or slow as the average pulls it at least halfway over, so a change in
+    network speed shows up within a file or two.  Time spent on each file
+    besides sending it (metadata, thumbnails, notes) is averaged separately.
+    """
+    def __init__(self, total_bytes, total_files, half_life=RATE_HALF_LIFE, clock=time.time):
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.half_life = half_life
+        self.clock = clock
+        self.done_bytes = 0
+        self.done_files = 0
+        # bytes per second and seconds per file, None until there's a sample
+        self.rate = None
+        self.overhead = None
+        self.__file_size = 0
+        self.__file_started = clock()
+
+    def start_file(self, size):
+        self.__file_size = size
+        self.__file_started = self.clock()
+
+    def transferred(self, nbytes, seconds):
+        """nbytes of the current file went over in seconds"""
+        self.done_bytes += nbytes
+        if seconds <= 0 or nbytes <= 0:
+            # an empty file says nothing about how fast bytes go
+            return
+        sample = nbytes / float(seconds)
+        if self.rate is None:
+            self.rate = sample
+            return
+        weight = 1.0 - 0.5 ** (seconds / self.half_life)
+        if self.rate and not (0.5 <= sample / self.rate <= 2.0):
+            # the network changed speed, don't wait for it to average in
+            weight = max(weight, 0.5)
+        self.rate += weight * (sample - self.rate)
+
+    def file_done(self, overhead):
+        """the current file is done, overhead seconds went to other than sending it"""
+        self.done_files += 1
+        if self.overhead is None:
+            self.overhead = overhead
+        else:
+            self.overhead += 0.3 * (overhead - self.overhead)
+
+    def expected(self, size):
+        """seconds a file of size should take, None if there's nothing to go on"""
+        if not self.rate:
+            return None
+        return size / self.rate + (self.overhead or 0.0)
+
+    def remaining(self):
+        """seconds left for everything not done yet, None if there's nothing to go on"""
+        if not self.rate:
+            return None
+        files = self.total_files - self.done_files
+        return max(0, self.total_bytes - self.done_bytes) / self.rate + files * (self.overhead or 0.0)
+
+    def stalled(self):
+        """seconds the current file has been going when it should have been done, otherwise 0"""
+        elapsed = self.clock() - self.__file_started
+        expected = self.expected(self.__file_size)
+        limit = STALL_SECONDS
+        if expected is not None:
+            limit = max(limit, expected * STALL_FACTOR)
+        if elapsed > limit:
+            return elapsed
+        return 0
+
+    def status(self):
+        """one line summary for the progress dialog"""
+        if not self.rate:
+            text = 'working out the rate...'
+        else:
+            text = '%s, about %s left' % (format_rate(self.rate), format_duration(self.remaining()))
+        stalled = self.stalled()
+        if stalled:
+            text += ' - STALLED? no progress for %s' % format_duration(stalled)
+        return text
+
+################################################################################
+# Multipart Uploads
+################################################################################
+class FileSlice(object):
+    """
+    A byte range of a file read like a file, for streaming a part as a request
+    body.  Keeps an md5 of what has been read to check against the part's etag.
+    """
+    def __init__(self, path, offset, length):
+        self.offset = offset
+        self.length = length
+        self.__fh = open(path, 'rb')
+        self.seek(0)
+
+    def seek(self, position):
+        """only back to the start, which is all a resend needs"""
+        self.__fh.seek(self.offset + position)
+        self.__left = self.length - position
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.__left:
+            size = self.__left
+        data = self.__fh.read(size)
+        self.__left -= len(data)
+        self.md5.update(data)
+        return data
+
+    def close(self):
+        self.__fh.close()
+
+class MultipartUploader(object):
+    """
+    Sends big files to S3 style storage as parts uploaded in parallel, each
+    over its own keep-alive connection, for when one stream can't fill the
+    link.  The storage puts the parts back together into one object.
+
+    Speaks the S3 multipart api (initiate, put parts, complete, abort) without
+    request signing, so the endpoint has to take unsigned requests: a bucket
+    open to the studio network or a gateway in front of one.  Each part is
+    tried PART_RETRIES times before the whole upload is given up on and
+    aborted.  Parts are checked against the md5 etags S3 style storage sends
+    back for them.
+    """
+    # S3 limits
+    MAX_PARTS = 10000
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, url, part_size=DEFAULT_PART_SIZE, workers=DEFAULT_PART_WORKERS, retries=PART_RETRIES):
+        (self.scheme, self.host, self.path) = urlparse.urlsplit(url)[:3]
+        self.url = url.rstrip('/')
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.pool = ConnectionPool(self.workers)
+        # stats
+        self.parts = 0
+        self.retried = 0
+
+    def wants(self, path):
+        """is path big enough to be worth splitting up"""
+        return os.path.getsize(path) > self.part_size
+
+    def upload(self, path, key=None, check=None):
+        """
+        Send path to the storage, returning the url it ends up at.  check() is
+        called before each part and can raise to give the upload up.
+        """
+        if key is None:
+            # somewhere of its own, uploads of same named files don't collide
+            key = '%s/%s' % (uuid.uuid4().hex, os.path.basename(path))
+        object_path = '%s/%s' % (self.path.rstrip('/'), urllib.quote(key))
+        size = os.path.getsize(path)
+        part_size = max(self.part_size, (size + self.MAX_PARTS - 1) / self.MAX_PARTS)
+        parts = [(i + 1, offset, min(part_size, size - offset)) for (i, offset) in enumerate(xrange(0, max(size, 1), part_size))]
+        data = self.__request('POST', object_path + '?uploads', '', 'start upload')
+        match = re.search(r'<UploadId>([^<]+)</UploadId>', data)
+        if match is None:
+            raise IOError('no upload id from %s: %s' % (self.url, data[:200]))
+        upload_id = match.group(1)
+        query = '?uploadId=%s' % urllib.quote(upload_id)
+        try:
+            etags = self.__send_parts(path, object_path, upload_id, parts, check)
+            body = ''.join(['<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (number, etags[number]) \
+                for (number, offset, length) in parts])
+            data = self.__request('POST', object_path + query,
+                '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % body, 'finish upload')
+            # S3 can say 200 and still have failed
+            if '<Error>' in data:
+                raise IOError("couldn't finish upload of %s: %s" % (path, data[:200]))
+        except:
+            error = sys.exc_info()
+            try:
+                self.pool.request(self.scheme, self.host, 'DELETE', object_path + query)
+            except (IOError, socket.error, httplib.HTTPException):
+                # it'll get cleaned up by the storage's own expiry
+                pass
+            raise error[0], error[1], error[2]
+        return '%s://%s%s' % (self.scheme, self.host, object_path)
+
+    def __request(self, method, url, body, what):
+        (status, reason, msg, data) = self.pool.request(self.scheme, self.host, method, url, body)
+        if status != 200:
+            raise IOError("couldn't %s at %s: %s %s %s" % (what, self.url, status, reason, data[:200]))
+        return data
+
+    def __send_parts(self, path, object_path, upload_id, parts, check=None):
+        """put all the parts from a pool of threads, returning part number -> etag"""
+        jobs = Queue.Queue()
+        for part in parts:
+            jobs.put(part)
+        etags = {}
+        errors = []
+        def work():
+            while not errors:
+                try:
+                    (number, offset, length) = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if check is not None:
+                        check()
+                    etags[number] = self.__send_part(path, object_path, upload_id, number, offset, length)
+                except Exception, e:
+                    errors.append(e)
+        threads = [threading.Thread(target=work, name='part%d' % i) for i in xrange(min(self.workers, len(parts)))]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return etags
+
+    def __send_part(self, path, object_path, upload_id, number, offset, length):
+        url = '%s?partNumber=%d&uploadId=%s' % (object_path, number, urllib.quote(upload_id))
+        headers = {'Content-Length': str(length), 'Content-Type': 'application/octet-stream'}
+        body = FileSlice(path, offset, length)
+        try:
+            for attempt in xrange(self.retries):
+                if attempt:
+                    self.retried += 1
+                    # give a struggling server a moment, more each time
+                    time.sleep(min(2 ** attempt, 30))
+                body.seek(0)
+                try:
+                    (status, reason, msg, data) = self.pool.request(self.scheme, self.host, 'PUT', url, body, headers)
+                except (IOError, socket.error, httplib.HTTPException), e:
+                    error = '%s: %s' % (e.__class__.__name__, e)
+                    continue
+                etag = msg.getheader('etag', '')
+                if status != 200:
+                    error = '%s %s' % (status, reason)
+                elif re.match(r'^"?[0-9a-f]{32}"?$', etag) and etag.strip('"') != body.md5.hexdigest():
+                    # the server got something other than what was sent
+                    error = 'etag mismatch'
+                else:
+                    self.parts += 1
+                    return etag or '"%s"' % body.md5.hexdigest()
+        finally:
+            body.close()
+        raise IOError('part %d of %s failed %d times, last with %s' % (number, path, self.retries, error))
+
+    def stats(self):
+        return '%d parts, %d retried' % (self.parts, self.retried)
+
+################################################################################
+# Sending
+################################################################################
+class FileSender(object):
+    """
+    Sends files to shotgun along with their metadata, thumbnail, and note.
+    Shared by the window and headless spool workers.
+    """
+    def __init__(self, conn, prefs, thumbnails, filmstrips, pool=None):
+        self.conn = conn
+        self.pool = pool
+        self.prefs = prefs
+        self.thumbnails = thumbnails
+        self.filmstrips = filmstrips
+        # thumbnails straight from memory when the api allows it
+        self.post_thumbnails = pool is not None and can_post_thumbnail(conn)
+        # big files go to storage in parts, if there's storage to send them to
+        self.multipart = None
+        if prefs.storage_url:
+            self.multipart = MultipartUploader(prefs.storage_url, prefs.part_size, prefs.part_workers)
+
+    def send(self, f, default_link, proxies=None, wait=None, check=None):
+        """
+        Upload f and attach it to default_link.  wait(func, *args) is used to
+        run the upload itself, so callers can keep busy in the meantime.
+        check() is called just before the upload, and between the parts of a
+        multipart one, and can raise to stop it.  Returns the Attachment id
+        and the seconds the upload took.
+        """
+        (f_id, sent) = self.upload(f, proxies, wait, check)
+        self.finish(f, f_id, default_link)
+        return (f_id, sent)
+
+    def upload(self, f, proxies=None, wait=None, check=None):
+        """the upload half of send, making the Attachment.  Returns its id and the seconds it took"""
+        if wait is None:
+            wait = lambda func, *args: func(*args)
+        conn = self.conn
+        upload_path = f.upload_path
+        movie_dir = None
+        try:
+            # sequences can be assembled into a movie to send instead of a frame
+            if isinstance(f, ShotgunSequence) and self.prefs.sequence_command:
+                # in a directory of our own, a bare temp name could be taken
+                # before the command gets to write it
+                movie_dir = tempfile.mkdtemp(prefix='uploader_')
+                movie = os.path.join(movie_dir, (os.path.basename(f.sequence.head).rstrip('._') or 'sequence') + '.mov')
+                cmd = self.prefs.sequence_command
+                cmd = cmd.replace('$in', '"%s"' % f.sequence.printf_pattern)
+                cmd = cmd.replace('$first', str(f.sequence.first))
+                cmd = cmd.replace('$out', '"%s"' % movie)
+                os.system(cmd)
+                if os.path.exists(movie):
+                    upload_path = movie
+            elif proxies is not None:
+                # the original still goes in path_field
+                proxies.submit(f.upload_path)
+                upload_path = proxies.result(f.upload_path) or upload_path
+            # upload
+            sending = time.time()
+            if check is not None:
+                check()
+            if self.multipart is not None and self.multipart.wants(upload_path):
+                url = wait(self.multipart.upload, upload_path, None, check)
+                f_id = self.attach_url(f, url)
+            else:
+                f_id = wait(conn.upload, f.link['type'], f.link['id'], upload_path)
+        finally:
+            if upload_path != f.upload_path and os.path.exists(upload_path):
+                os.remove(upload_path)
+            if movie_dir is not None:
+                shutil.rmtree(movie_dir, True)
+        return (f_id, time.time() - sending)
+
+    def finish(self, f, f_id, default_link):
+        """the rest of send once the Attachment f_id is made, what a retry runs again"""
+        conn = self.conn
+        # update tags, path, and reference for
+        data = {'attachment_reference_links': [default_link]}
+        if self.prefs.path_field:
+            data[self.prefs.path_field] = f.path
+        if f.tags:
+            data['tag_list'] = f.tags.split(',')
+        conn.update('Attachment', f_id, data)
+        # do thumbnails for files we can, sequences use their frame
+        thumb = self.thumbnail(f)
+        if thumb is not None:
+            self.send_thumbnail(f_id, thumb)
+        if f.note:
+            # add the note if set
+            conn.create('Note', {'content': f.note, 'note_links': [{'type': 'Attachment', 'id': f_id}], \
+                'project': f.link.get('project', f.link)})
+
+    def close(self):
+        """close the connections to storage, for when a batch of sends is done"""
+        if self.multipart is not None:
+            self.multipart.pool.close()
+
+    def attach_url(self, f, url):
+        """make an Attachment pointing at url where f was uploaded to, returning its id"""
+        data = {'this_file': {'url': url, 'name': os.path.basename(f.path)},
+            'attachment_links': [{'type': f.link['type'], 'id': f.link['id']}]}
+        if f.link.get('project'):
+            data['project'] = f.link['project']
+        return self.conn.create('Attachment', data)['id']
+
+    def thumbnail(self, f):
+        """jpeg data for the thumbnail of f, or None if one can't be made"""
+        mime = mimetypes.guess_type(f.upload_path)[0] or ''
+        if mime.startswith('image'):
+            thumb = self.thumbnails.result(f.upload_path)
+            cmd = self.prefs.image_command
+        elif mime.startswith('video'):
+            # reuse the frame picked from the filmstrip if there is one
+            thumb = self.filmstrips.frame(f.upload_path, f.hero_offset)
+            cmd = self.prefs.movie_command
+        else:
+            return None
+        if thumb is None and cmd:
+            thumb = run_thumbnail_command(cmd, f.upload_path, f.hero_offset)
+        return thumb
+
+    def send_thumbnail(self, f_id, thumb):
+        """upload jpeg data as the thumbnail of an Attachment"""
+        if self.post_thumbnails:
+            try:
+                post_thumbnail(self.conn, self.pool, 'Attachment', f_id, thumb)
+                return
+            except (IOError, httplib.HTTPException):
+                # the server or api isn't what post_thumbnail expects, stick
+                # to the api's own way from here on
+                self.post_thumbnails = False
+        # the api's own way, it only takes files
+        (fd, tmp) = tempfile.mkstemp('.jpg', 'uploader_')
+        try:
+            os.write(fd, thumb)
+            os.close(fd)
+            self.conn.upload_thumbnail('Attachment', f_id, tmp)
+        finally:
+            os.remove(tmp)
+
+def read_command(cmd, limit=THUMBNAIL_MAX_BYTES):
+    """
+    Run a shell command and return what it writes to stdout, or None if it
+    fails, writes nothing, or writes more than limit bytes.
+    """
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    chunks = []
+    total = 0
+    while True:
+        chunk = proc.stdout.read(65536)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            # closing the pipe ends it with a broken pipe
+            proc.stdout.close()
+            proc.wait()
+            return None
+        chunks.append(chunk)
+    proc.stdout.close()
+    if proc.wait() != 0 or not total:
+        return None
+    return ''.join(chunks)
+
+def run_thumbnail_command(cmd, path, offset, limit=THUMBNAIL_MAX_BYTES):
+    """
+    Make a thumbnail with a command from the prefs and return it as data.
+    Without $out the command writes the jpeg to stdout and nothing touches the
+    disk, otherwise it goes through a temporary file.
+    """
+    cmd = cmd.replace('$in', '"%s"' % path)
+    cmd = cmd.replace('$offset', '"%s"' % offset)
+    if '$out' not in cmd:
+        return read_command(cmd, limit)
+    (fd, tmp) = tempfile.mkstemp('.jpg', 'uploader_')
+    os.close(fd)
+    try:
+        os.system(cmd.replace('$out', '"%s"' % tmp))
+        size = os.path.getsize(tmp)
+        if not size or size > limit:
+            return None
+        fh = open(tmp, 'rb')
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+################################################################################
+# Spool
+################################################################################
+def worker_name():
+    """host:pid, unique among the workers sharing a spool"""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+class Spool(object):
+    """
+    A queue of files to upload kept in a directory, so any number of
+    uploaders and headless workers, on this host or others that mount it, can
+    share the work.
+
+    Jobs live in a sqlite database in the directory.  Claims happen inside an
+    immediate transaction, which takes sqlite's write lock before looking for
+    a job, so two workers can never claim the same one.  A claim is a lease: a
+    worker that stops renewing it (because it died, or its host did) loses the
+    job to the next worker that asks once the lease runs out.  A job that has
+    been tried SPOOL_ATTEMPTS times is marked failed instead.  Counts of what
+    each worker did are kept alongside for stats().
+
+    Sharing between hosts relies on the filesystem's locking working, which is
+    the case for local disks and NFSv4, but not for every network filesystem.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # transactions are managed by hand
+        self.__db = sqlite3.connect(os.path.join(directory, 'spool.db'), timeout=60, isolation_level=None)
+        self.__db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            queued REAL,
+            finished REAL)""")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self.__db.execute("""CREATE TABLE IF NOT EXISTS workers (
+            name TEXT PRIMARY KEY,
+            claimed INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            seconds REAL NOT NULL DEFAULT 0,
+            last_seen REAL)""")
+
+    def close(self):
+        self.__db.close()
+
+    def __begin(self):
+        # take the write lock up front, waiting up to the connect timeout for it
+        self.__db.execute('BEGIN IMMEDIATE')
+
+    def __count(self, worker, column, amount=1, seconds=0.0):
+        self.__db.execute('INSERT OR IGNORE INTO workers (name) VALUES (?)', (worker,))
+        self.__db.execute('UPDATE workers SET %s = %s + ?, seconds = seconds + ?, last_seen = ? WHERE name = ?' % \
+            (column, column), (amount, seconds, time.time(), worker))
+
+    def enqueue(self, payloads):
+        """add jobs, payloads being anything json can store.  Returns their ids"""
+        now = time.time()
+        ids = []
+        self.__begin()
+        try:
+            for payload in payloads:
+                cursor = self.__db.execute('INSERT INTO jobs (payload, queued) VALUES (?, ?)', (json.dumps(payload), now))
+                ids.append(cursor.lastrowid)
+            self.__db.execute('COMMIT')
+        except:
+            self.__db.execute('ROLLBACK')
+            raise
+        return ids
+
+    def claim(self, worker, lease=SPOOL_LEASE):
+        """
+        Claim the oldest job that's queued or whose lease has run out.
+        Returns (id, payload), or None if there's nothing to do.
+        """
+        now = time.time()
+        self.__begin()
+        try:
+            while True:
+                # separate queries so each can walk the state index, there are
+                # only ever a few claimed jobs but done ones pile up
+                row = self.__db.execute("""SELECT id, payload, attempts FROM jobs
+                    WHERE state = 'claimed' AND lease_expires < ? ORDER BY id LIMIT 1""", (now,)).fetchone()
+                if row is None:
+                    row = self.__db.execute("""SELECT id, payload, attempts FROM jobs
+                        WHERE state = 'queued' ORDER BY id LIMIT 1""").fetchone()
+                if row is None:
+                    self.__db.execute('COMMIT')
+                    return None
+                (job_id, payload, attempts) = row
+                if attempts >= SPOOL_ATTEMPTS:
+                    # whoever had it last died with it, don't take anyone else down
+                    self.__db.execute("UPDATE jobs SET state = 'failed', error = ?, finished = ? WHERE id = ?",
+                        ('lease ran out %d times' % attempts, now, job_id))
+                    continue
+                self.__db.execute("""UPDATE jobs SET state = 'claimed', worker = ?, lease_expires = ?,
+                    attempts = attempts + 1 WHERE id = ?""", (worker, now + lease, job_id))
+                self.__count(worker, 'claimed')
+                self.__db.execute('COMMIT')
+                return (job_id, json.loads(payload))
+        except:
+            self.__db.execute('ROLLBACK')
+            raise
+
+    def renew(self, job_id, worker, lease=SPOOL_LEASE):
+        """extend the lease on a claimed job.  False if it's no longer worker's"""
+        cursor = self.__db.execute("""UPDATE jobs SET lease_expires = ?
+            WHERE id = ? AND worker = ? AND state = 'claimed'""", (time.time() + lease, job_id, worker))
+        return cursor.rowcount == 1
+
+    def update(self, job_id, worker, payload):
+        """
+        Replace the payload of a claimed job, so a retry can pick up where
+        this try got to.  False if it's no longer worker's.
+        """
+        cursor = self.__db.execute("""UPDATE jobs SET payload = ?
+            WHERE id = ? AND worker = ? AND state = 'claimed'""", (json.dumps(payload), job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, nbytes, seconds):
+        """
+        Mark a claimed job done and count it for worker.  False if the lease ran
+        out and someone else claimed it in the meantime.
+        """
+        self.__begin()
+        try:
+            cursor = self.__db.execute("""UPDATE jobs SET state = 'done', error = NULL, finished = ?
+                WHERE id = ? AND worker = ? AND state = 'claimed'""", (time.time(), job_id, worker))
+            # the bytes went over either way, but the job is only done once
+            self.__count(worker, 'done', cursor.rowcount, seconds)
+            self.__count(worker, 'bytes', nbytes)
+            self.__db.execute('COMMIT')
+        except:
+            self.__db.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        """
+        Give up on a claimed job, queueing it again for another try if it has
+        any left.  Returns True if it was queued again.
+        """
+        self.__begin()
+        try:
+            row = self.__db.execute("SELECT attempts FROM jobs WHERE id = ? AND worker = ? AND state = 'claimed'",
+                (job_id, worker)).fetchone()
+            retry = row is not None and row[0] < SPOOL_ATTEMPTS
+            if row is not None:
+                self.__db.execute('UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?',
+                    (retry and 'queued' or 'failed', error, time.time(), job_id))
+            self.__count(worker, 'failed')
+            self.__db.execute('COMMIT')
+        except:
+            self.__db.execute('ROLLBACK')
+            raise
+        return retry
 
-################################################################################
-# Model
-################################################################################
-class ShotgunFileModel(QtCore.QAbstractTableModel):
-    # Mapping from display text to an attribute of the modeled object
-    __HEADERS = [
-        {'disp': 'Frame', 'attr': 'hero_offset', 'default': '', 'editable': True},
-        {'disp': 'Path', 'attr': 'path', 'default': '', 'editable': False},
-        {'disp': 'Linked To', 'attr': 'link_name', 'default': '', 'editable': False},
-        {'disp': 'Tags', 'attr': 'tags', 'default': '', 'editable': True},
-        {'disp': 'Note', 'attr': 'note', 'default': '', 'editable': True},
-    ]
+    def release(self, job_id, worker):
+        """hand a claimed job back untried, for workers shutting down"""
+        self.__db.execute("""UPDATE jobs SET state = 'queued', worker = NULL, attempts = attempts - 1
+            WHERE id = ? AND worker = ? AND state = 'claimed'""", (job_id, worker))
 
-    # model methods
-    def __init__(self, undo_stack, parent=None):
-        """constructor"""
-        super(ShotgunFileModel, self).__init__(parent)
-        self.stack = undo_stack
-        self.files = []
+    def counts(self):
+        """number of jobs in each state"""
+        counts = dict([(state, 0) for state in ('queued', 'claimed', 'done', 'failed')])
+        for (state, n) in self.__db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'):
+            counts[str(state)] = n
+        return counts
 
-    def rowCount(self, parent=QtCore.QModelIndex()):
-        """number of rows is the number of files"""
-        return len(self.files)
+    def failures(self):
+        """(id, payload, error) for failed jobs"""
+        return [(job_id, json.loads(payload), error) for (job_id, payload, error) in \
+            self.__db.execute("SELECT id, payload, error FROM jobs WHERE state = 'failed' ORDER BY id")]
 
-    def columnCount(self, parent=QtCore.QModelIndex()):
-        """number of columns is the number of headers"""
-        return len(self.__HEADERS)
+    def stats(self):
+        """a dict per worker of what it claimed, finished, and failed, and how fast"""
+        stats = []
+        for row in self.__db.execute("""SELECT name, claimed, done, failed, bytes, seconds, last_seen
+                FROM workers ORDER BY name"""):
+            stat = dict(zip(('name', 'claimed', 'done', 'failed', 'bytes', 'seconds', 'last_seen'), row))
+            stat['rate'] = stat['seconds'] and stat['bytes'] / stat['seconds'] or 0.0
+            stats.append(stat)
+        return stats
 
-    def data(self, index, role=QtCore.Qt.DisplayRole):
-        """method to return data for the various display roles in qt"""
-        # display role, actually return the info
-        if index.isValid() and role == QtCore.Qt.DisplayRole:
-            f = self.files[index.row()]
-            attr = self.__HEADERS[index.column()]['attr']
-            ret = getattr(f, attr, None)
-            if ret is not None:
-                return QtCore.QVariant(ret)
-            else:
-                return QtCore.QVariant(self.__HEADERS[index.column()]['default'])
-        # not worrying about this role, just return invalid variant
-        return QtCore.QVariant()
+def format_spool_stats(spool):
+    """table of job counts and per worker stats, for the command line"""
+    counts = spool.counts()
+    lines = ['%(queued)d queued, %(claimed)d claimed, %(done)d done, %(failed)d failed' % counts, '']
+    lines.append('%-32s %7s %6s %6s %12s %19s' % ('worker', 'claimed', 'done', 'failed', 'rate', 'last seen'))
+    for stat in spool.stats():
+        last_seen = stat['last_seen'] and time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat['last_seen'])) or ''
+        lines.append('%-32s %7d %6d %6d %12s %19s' % (stat['name'], stat['claimed'], stat['done'], stat['failed'],
+            format_rate(stat['rate']), last_seen))
+    return '\n'.join(lines)
 
-    def headerData(self, section, orientation, role):
-        """return data for header row"""
-        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
-            return QtCore.QVariant(self.__HEADERS[section]['disp'])
-        return QtCore.QVariant()
+class LeaseLost(Exception):
+    """a worker's lease on its job ran out, someone else may be sending it"""
 
-    def setData(self, index, value, role):
-        """set data for a given index"""
-        if (role != QtCore.Qt.EditRole):
-            return False
-        self.stack.push(ChangeValueCommand(index, value, self))
-        return True
+class LeaseKeeper(threading.Thread):
+    """renews the lease on a job while it's being worked on"""
+    def __init__(self, directory, job_id, worker, lease=SPOOL_LEASE):
+        threading.Thread.__init__(self, name='lease%d' % job_id)
+        self.setDaemon(True)
+        self.directory = directory
+        self.job_id = job_id
+        self.worker = worker
+        self.lease = lease
+        self.lost = False
+        self.__renewed = time.time()
+        self.__done = threading.Event()
 
-    # drag and drop methods
-    def supportedDropActions(self):
-        """what drop actions do we support, treat move or copy as an insert"""
-        return QtCore.Qt.MoveAction | QtCore.Qt.CopyAction
+    def run(self):
+        # sqlite connections stay on the thread that made them
+        spool = Spool(self.directory)
+        try:
+            while not self.__done.isSet():
+                self.__done.wait(self.lease / 3)
+                if self.__done.isSet():
+                    break
+                renewed = time.time()
+                if spool.renew(self.job_id, self.worker, self.lease):
+                    self.__renewed = renewed
+                else:
+                    self.lost = True
+        finally:
+            spool.close()
 
-    def flags(self, index):
-        """all items can accept drops, hero_offset is editable for video, otherwise use editable"""
-        flags = QtCore.Qt.ItemIsDropEnabled | QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
-        if self.__HEADERS[index.column()]['attr'] == 'hero_offset':
-            f = self.files[index.row()]
-            mime_guess = mimetypes.guess_type(f.path)[0]
-            if mime_guess is not None and mime_guess.startswith('video'):
-                flags |= QtCore.Qt.ItemIsEditable
-        elif self.__HEADERS[index.column()]['editable']:
-            flags |= QtCore.Qt.ItemIsEditable
-        return flags
+    def check(self):
+        """raise LeaseLost if the job may not be ours anymore"""
+        # renewals that can't get through (a locked spool, a sleeping
+        # machine) let the lease run out just the same
+        if self.lost or time.time() - self.__renewed > self.lease:
+            raise LeaseLost('lease on job %d ran out' % self.job_id)
 
-    def mimeTypes(self):
-        """return a list of supported mime types.  enables drop"""
-        # text/uri-list is what most finder style file browsers use
-        return QtCore.QStringList(['text/uri-list'])
+    def stop(self):
+        self.__done.set()
+        self.join()
 
-    def dropMimeData(self, data, action, row, column, parent):
-        """handle the drop action, currently just uri-list"""
-        if data.hasFormat('text/uri-list'):
-            if data.hasUrls():
-                files = [str(url.toLocalFile()) for url in data.urls()]
-            elif data.hasText():
-                files = [str(urllib.urlretrieve(uri)[0]) for uri in str(data.text()).split() \
-                                                        if urllib.splittype(uri)[0] == 'file']
-            # Just let people know what's been added
-            self.emit(QtCore.SIGNAL('filesAdded(QStringList)'), files)
-            return True
-        return False
+class SpoolWorker(object):
+    """claims jobs from a spool and sends them, for the window and headless workers"""
+    def __init__(self, spool, sender, name=None, lease=SPOOL_LEASE):
+        self.spool = spool
+        self.sender = sender
+        self.name = name or worker_name()
+        self.lease = lease
+        # proxy rules text -> ProxyStage, jobs carry the rules they were queued with
+        self.__proxies = {}
 
-    # model object access
-    def _update_data(self, row, column, value):
-        """update internal data at (row, column) to value"""
-        f = self.files[row]
-        setattr(f, self.__HEADERS[column]['attr'], str(value))
-        index = self.index(row, column)
-        self.emit(QtCore.SIGNAL('modelReset()'))
-        # self.emit(QtCore.SIGNAL('dataChanged(index, index)'), index, index)
+    def claim(self):
+        """(job id, file, payload) for the next job, or None if there isn't one"""
+        job = self.spool.claim(self.name, self.lease)
+        if job is None:
+            return None
+        (job_id, payload) = job
+        return (job_id, file_from_dict(payload['file']), payload)
 
-    def clear(self):
-        self.files = []
-        self.reset()
-        self.emit(QtCore.SIGNAL('modelReset()'))
+    def work(self, job_id, f, payload, wait=None):
+        """
+        Send a claimed file and record how it went in the spool.  Returns None
+        on success, otherwise the error.
+        """
+        keeper = LeaseKeeper(self.spool.directory, job_id, self.name, self.lease)
+        keeper.start()
+        started = time.time()
+        try:
+            try:
+                proxies = None
+                rules = payload.get('proxy_rules')
+                if rules:
+                    if rules not in self.__proxies:
+                        self.__proxies[rules] = ProxyStage(parse_proxy_rules(rules))
+                    proxies = self.__proxies[rules]
+                f_id = payload.get('attachment_id')
+                if f_id is None:
+                    f_id = self.sender.upload(f, proxies, wait, keeper.check)[0]
+                    # a retry of anything after this carries on from the
+                    # Attachment rather than making another one
+                    payload['attachment_id'] = f_id
+                    self.spool.update(job_id, self.name, payload)
+                self.sender.finish(f, f_id, payload['default_link'])
+            except (KeyboardInterrupt, SystemExit):
+                self.spool.release(job_id, self.name)
+                raise
+            except LeaseLost, e:
+                # stop before sending it twice, if nobody has picked it up
+                # yet it goes back in the queue
+                self.spool.release(job_id, self.name)
+                return e
+            except Exception, e:
+                self.spool.fail(job_id, self.name, '%s: %s' % (e.__class__.__name__, e))
+                return e
+        finally:
+            keeper.stop()
+        self.spool.complete(job_id, self.name, f.size, time.time() - started)
+        return None
 
-    def insert_files(self, files, row):
-        self.beginInsertRows(QtCore.QModelIndex(), row, row+len(files)-1)
-        self.files[row:row] = files
-        self.endInsertRows()
+    def close(self):
+        for proxies in self.__proxies.values():
+            proxies.close()
+        self.__proxies = {}
+        self.sender.close()
 
-    def append_files(self, files):
-        self.insert_files(files, len(self.files))
+def load_shotgun_api(api_path):
+    """import the shotgun api from where the prefs say it is, raising ImportError if it isn't there"""
+    if os.path.isdir(api_path):
+        sys.path.append(api_path)
+    else:
+        sys.path.append(os.path.dirname(api_path))
+    try:
+        import shotgun_api3_preview as sg
+    except ImportError:
+        sys.path.pop()
+        raise
+    return sg
 
-    def delete_files(self, first, last):
-        self.beginRemoveRows(QtCore.QModelIndex(), first, last)
-        self.files[first:last] = []
-        self.endRemoveRows()
-        self.emit(QtCore.SIGNAL('modelReset()'))
+def run_worker(directory, name=None, exit_when_empty=False):
+    """
+    Work through a spool with no window until interrupted, or until it's
+    empty if exit_when_empty.  Returns an exit status.
+    """
+    prefs = SavedPrefs()
+    try:
+        sg = load_shotgun_api(prefs.shotgun_api)
+    except ImportError:
+        print >> sys.stderr, 'shotgun_api3_preview module not found.  Update your Preferences.'
+        return 1
+    conn = sg.Shotgun(prefs.shotgun_url, prefs.shotgun_script, prefs.shotgun_key)
+    pool = ConnectionPool()
+    if not install_connection_pool(conn, pool):
+        print >> sys.stderr, NO_POOL_WARNING
+    spool = Spool(directory)
+    worker = SpoolWorker(spool, FileSender(conn, prefs, ThumbnailEngine(), FilmstripCache(), pool), name)
+    print '%s working on %s' % (worker.name, directory)
+    try:
+        try:
+            while True:
+                job = worker.claim()
+                if job is None:
+                    if exit_when_empty and not spool.counts()['claimed']:
+                        break
+                    time.sleep(SPOOL_POLL)
+                    continue
+                (job_id, f, payload) = job
+                started = time.time()
+                error = worker.work(job_id, f, payload)
+                if error is None:
+                    print 'sent %s (%s in %s)' % (f.path, format_rate(f.size / max(time.time() - started, 0.001)),
+                        format_duration(time.time() - started))
+                else:
+                    print >> sys.stderr, 'failed %s: %s' % (f.path, error)
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        worker.close()
+        spool.close()
+        pool.close()
+    print pool.stats()
+    return 0
 
 ################################################################################
-# File Object
+# Diagnostics
 ################################################################################
-class ShotgunFile(object):
-    """wrapper around info needed to upload a file"""
-    def __init__(self, path, tags, link, hero_offset=None, note=''):
-        self.path = path
-        self.tags = tags
-        self.hero_offset = ''
-        self.link = link
-        self.note = note
-        self.link_name = link.get('name', link.get('code', ''))
-        if hero_offset is None:
-            # default offset to 1 for video mime-types
-            mime_guess = mimetypes.guess_type(path)[0]
-            if mime_guess is not None and mime_guess.startswith('video'):
-                self.hero_offset = '1'
-        self.size = os.path.getsize(path)
+class StallWatchdog(QtCore.QObject):
+    """
+    Notices when the event loop stops turning and records what it was stuck in.
 
-################################################################################
-# Commands
-################################################################################
-class ChangeValueCommand(QtGui.QUndoCommand):
-    def __init__(self, index, value, model, text='value change', parent=None):
-        QtGui.QUndoCommand.__init__(self, text, parent)
-        self.__old = index.data(QtCore.Qt.DisplayRole).toString()
-        self.__new = value.toString()
-        self.__row = index.row()
-        self.__col = index.column()
-        self.__model = model
+    A timer on the gui thread checks in every STALL_HEARTBEAT milliseconds.
+    A python thread watches for check ins that are more than threshold seconds
+    late and grabs the gui thread's stack while it is still stuck, again each
+    threshold if it has moved on to something else.  Stacks go to the log file
+    (stderr if there is none) and stalled(PyQt_PyObject) is emitted with
+    (seconds, stack) once the gui thread is back.
+    """
+    def __init__(self, threshold=STALL_THRESHOLD, log=None, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.threshold = threshold
+        self.log = log
+        # (seconds, stack) of each stall so far
+        self.stalls = []
+        self.__gui_thread = thread.get_ident()
+        self.__lock = threading.Lock()
+        self.__beat = time.time()
+        # [last check in, first stack, last stack, when to look again] while stalled
+        self.__stall = None
+        self.__done = threading.Event()
+        self.__watcher = None
+        self.__timer = QtCore.QTimer(self)
+        self.__timer.setInterval(STALL_HEARTBEAT)
+        self.connect(self.__timer, QtCore.SIGNAL('timeout()'), self.__heartbeat)
 
-    def redo(self):
-        self.__model._update_data(self.__row, self.__col, self.__new)
+    def start(self):
+        if self.threshold <= 0:
+            return
+        self.__beat = time.time()
+        self.__timer.start()
+        self.__watcher = threading.Thread(target=self.__watch, name='watchdog')
+        self.__watcher.setDaemon(True)
+        self.__watcher.start()
 
-    def undo(self):
-        self.__model._update_data(self.__row, self.__col, self.__old)
+    def stop(self):
+        self.__timer.stop()
+        self.__done.set()
+        if self.__watcher is not None:
+            self.__watcher.join()
 
-################################################################################
-class NewFileCommand(QtGui.QUndoCommand):
-    def __init__(self, model, files, text='new files', parent=None):
-        QtGui.QUndoCommand.__init__(self, text, parent)
-        self.model = model
-        self.files = files
+    def __heartbeat(self):
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            self.__beat = now
+            stall = self.__stall
+            self.__stall = None
+        finally:
+            self.__lock.release()
+        if stall is not None:
+            seconds = now - stall[0]
+            self.__write('ui responsive again after %.1fs' % seconds)
+            self.stalls.append((seconds, stall[1]))
+            self.emit(QtCore.SIGNAL('stalled(PyQt_PyObject)'), (seconds, stall[1]))
 
-    def redo(self):
-        self.first = self.model.rowCount()
-        self.model.append_files(self.files)
-        self.last = self.model.rowCount()
+    def __watch(self):
+        while not self.__done.isSet():
+            self.__done.wait(self.threshold / 4.0)
+            self.__lock.acquire()
+            try:
+                late = time.time() - self.__beat
+                if late < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.__gui_thread)
+                stack = frame is not None and ''.join(traceback.format_stack(frame)) or ''
+                if self.__stall is None:
+                    self.__stall = [self.__beat, stack, stack, late + self.threshold]
+                    message = 'ui stalled for %.1fs, in:\n%s' % (late, stack)
+                elif late >= self.__stall[3]:
+                    self.__stall[3] = late + self.threshold
+                    if stack == self.__stall[2]:
+                        continue
+                    self.__stall[2] = stack
+                    message = 'ui still stalled after %.1fs, now in:\n%s' % (late, stack)
+                else:
+                    continue
+            finally:
+                self.__lock.release()
+            self.__write(message)
 
-    def undo(self):
-        self.model.delete_files(self.first, self.last)
+    def __write(self, message):
+        line = '%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), message)
+        if self.log is None:
+            sys.stderr.write(line)
+            return
+        fh = open(self.log, 'a')
+        try:
+            fh.write(line)
+        finally:
+            fh.close()
 
-################################################################################
-class DeleteFilesCommand(QtGui.QUndoCommand):
-    def __init__(self, model, rows, text='delete files', parent=None):
-        QtGui.QUndoCommand.__init__(self, text, parent)
-        self.model = model
-        self.files = dict([(row, model.files[row]) for row in rows])
+def innermost(stack):
+    """the last 'File ..., line N, in func' of a formatted stack, for a one line summary"""
+    lines = [line.strip() for line in stack.splitlines() if line.strip().startswith('File ')]
+    return lines and lines[-1] or 'unknown'
 
-    def redo(self):
-        # make sure we do this in reverse order so rows stay accurate while
-        # deleting
-        for row in reversed(sorted(self.files.keys())):
-            self.model.delete_files(row, row+1)
+class SessionProfiler(object):
+    """cProfile of the gui thread, dumped to a file for pstats or snakeviz"""
+    def __init__(self):
+        self.path = None
+        self.__profile = None
 
-    def undo(self):
-        # make sure we do this in row order to keep things as they were
-        for row in sorted(self.files.keys()):
-            self.model.insert_files([self.files[row]], row)
+    def available(self):
+        return cProfile is not None
+
+    def running(self):
+        return self.__profile is not None
+
+    def start(self, path):
+        """profile from now until stop, then write it to path"""
+        if not self.available() or self.running():
+            return False
+        self.path = path
+        self.__profile = cProfile.Profile()
+        self.__profile.enable()
+        return True
+
+    def stop(self):
+        """stop profiling and write it out, returning where to"""
+        if not self.running():
+            return None
+        self.__profile.disable()
+        self.__profile.dump_stats(self.path)
+        self.__profile = None
+        return self.path
 
 ################################################################################
 # Prefereneces
 ################################################################################
+class SavedPrefs(object):
+    """the saved settings, read without a dialog for headless workers and by PrefsDialog to fill its fields"""
+    def __init__(self):
+        settings = QtCore.QSettings('ShotgunSharing', 'uploader')
+        self.image_command = str(settings.value("prefs/image_command", DEFAULT_IMAGE_COMMAND).toString())
+        self.movie_command = str(settings.value("prefs/movie_command", DEFAULT_MOVIE_COMMAND).toString())
+        self.shotgun_url = str(settings.value("prefs/shotgun_url", DEFAULT_SHOTGUN_URL).toString())
+        self.shotgun_script = str(settings.value("prefs/shotgun_script", DEFAULT_SHOTGUN_SCRIPT).toString())
+        self.shotgun_key = str(settings.value("prefs/shotgun_key", DEFAULT_SHOTGUN_KEY).toString())
+        self.shotgun_api = str(settings.value("prefs/shotgun_api", DEFAULT_SHOTGUN_API).toString())
+        self.path_field = str(settings.value("prefs/path_field", DEFAULT_PATH_FIELD).toString())
+        self.link_map = str(settings.value("prefs/link_map", DEFAULT_LINK_MAP).toString())
+        self.sequence_command = str(settings.value("prefs/sequence_command", DEFAULT_SEQUENCE_COMMAND).toString())
+        self.proxy_rules = str(settings.value("prefs/proxy_rules", DEFAULT_PROXY_RULES).toString())
+        self.storage_url = str(settings.value("prefs/storage_url", DEFAULT_STORAGE_URL).toString())
+        self.part_size = settings.value("prefs/part_size", QtCore.QVariant(DEFAULT_PART_SIZE)).toInt()[0]
+        self.part_workers = settings.value("prefs/part_workers", QtCore.QVariant(DEFAULT_PART_WORKERS)).toInt()[0]
+
 class PrefsDialog(QtGui.QDialog):
     def __init__(self):
         QtGui.QDialog.__init__(self)
         # setup gui
         self.gui = Ui_Preferences()
         self.gui.setupUi(self)
-        # restore state
+        # restore state, read by SavedPrefs so the keys and defaults are in one place
+        saved = SavedPrefs()
+        self.gui.image_command.setText(saved.image_command)
+        self.gui.movie_command.setText(saved.movie_command)
+        self.gui.shotgun_url.setText(saved.shotgun_url)
+        self.gui.shotgun_script.setText(saved.shotgun_script)
+        self.gui.shotgun_key.setText(saved.shotgun_key)
+        self.gui.shotgun_api.setText(saved.shotgun_api)
+        self.gui.path_field.setText(saved.path_field)
+        self.gui.link_map.setText(saved.link_map)
+        # no field in the dialog for these, set in the defaults or the settings file
+        self.sequence_command = saved.sequence_command
+        self.proxy_rules = saved.proxy_rules
+        self.storage_url = saved.storage_url
+        self.part_size = saved.part_size
+        self.part_workers = saved.part_workers
         settings = QtCore.QSettings('ShotgunSharing', 'uploader')
-        self.gui.image_command.setText(settings.value("prefs/image_command", DEFAULT_IMAGE_COMMAND).toString())
-        self.gui.movie_command.setText(settings.value("prefs/movie_command", DEFAULT_MOVIE_COMMAND).toString())
-        self.gui.shotgun_url.setText(settings.value("prefs/shotgun_url", DEFAULT_SHOTGUN_URL).toString())
-        self.gui.shotgun_script.setText(settings.value("prefs/shotgun_script", DEFAULT_SHOTGUN_SCRIPT).toString())
-        self.gui.shotgun_key.setText(settings.value("prefs/shotgun_key", DEFAULT_SHOTGUN_KEY).toString())
-        self.gui.shotgun_api.setText(settings.value("prefs/shotgun_api", DEFAULT_SHOTGUN_API).toString())
-        self.gui.path_field.setText(settings.value("prefs/path_field", DEFAULT_PATH_FIELD).toString())
-        self.gui.link_map.setText(settings.value("prefs/link_map", DEFAULT_LINK_MAP).toString())
         self.restoreGeometry(settings.value("prefs/geometry").toByteArray())
         # hook up buttons
         self.connect(self.gui.buttons, QtCore.SIGNAL('accepted()'), self.ok)
@@ -294,12 +3128,46 @@ class PrefsDialog(QtGui.QDialog):
         # always save geometry.  don't care about the other settings
         settings.setValue("prefs/geometry", self.saveGeometry())
 
+################################################################################
+# Command Line
+################################################################################
+# options QApplication takes for itself, with a value and without
+QT_VALUE_OPTIONS = ['-style', '-stylesheet', '-session', '-graphicssystem', '-display', '-geometry',
+    '-font', '-fn', '-background', '-bg', '-foreground', '-fg', '-button', '-btn', '-name', '-title',
+    '-visual', '-ncols', '-cmap', '-im', '-inputstyle', '-platform', '-qwindowgeometry']
+QT_FLAG_OPTIONS = ['-reverse', '-widgetcount', '-sync', '-nograb', '-dograb']
+
+def split_qt_args(argv):
+    """
+    Split argv into (Qt's arguments, ours), both starting with the program,
+    so the uploader's options can be parsed strictly without turning away
+    -style and friends.
+    """
+    (qt, ours) = (argv[:1], argv[:1])
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        option = arg.split('=', 1)[0]
+        if option in QT_VALUE_OPTIONS and '=' not in arg:
+            # the value is the next argument
+            qt.extend(argv[i:i+2])
+            i += 1
+        elif option in QT_VALUE_OPTIONS or option in QT_FLAG_OPTIONS:
+            qt.append(arg)
+        else:
+            ours.append(arg)
+        i += 1
+    return (qt, ours)
+
 ################################################################################
 # Main Window
 ################################################################################
 class Uploader(QtGui.QMainWindow):
-    def __init__(self):
+    def __init__(self, spool=None, profiler=None):
         QtGui.QMainWindow.__init__(self)
+        # files go through a shared spool instead of straight up if set
+        self.spool = spool
+        self.profiler = profiler or SessionProfiler()
         # setup gui
         self.gui = Ui_MainWindow()
         self.gui.setupUi(self)
@@ -311,9 +3179,72 @@ class Uploader(QtGui.QMainWindow):
         redo.setShortcut(QtGui.QKeySequence('Shift+Ctrl+Z'))
         self.gui.menuEdit.addAction(undo)
         self.gui.menuEdit.addAction(redo)
-        # setup model
+        # pick hero frames from a filmstrip
+        self.action_hero_frame = QtGui.QAction('Choose &Hero Frame...', self)
+        self.action_hero_frame.setShortcut(QtGui.QKeySequence('Ctrl+H'))
+        self.gui.menuEdit.addSeparator()
+        self.gui.menuEdit.addAction(self.action_hero_frame)
+        # edit a column of every selected row in one go
+        self.action_bulk_edit = QtGui.QAction('&Bulk Edit...', self)
+        self.action_bulk_edit.setShortcut(QtGui.QKeySequence('Ctrl+B'))
+        self.gui.menuEdit.addAction(self.action_bulk_edit)
+        # opt in to collapsing numbered frames into sequences
+        self.action_sequences = QtGui.QAction('Group Frame &Sequences', self)
+        self.action_sequences.setCheckable(True)
+        self.gui.menu_File.insertAction(self.gui.action_Preferences, self.action_sequences)
+        # opt in to sending proxies instead of originals
+        self.action_proxies = QtGui.QAction('Upload &Proxies', self)
+        self.action_proxies.setCheckable(True)
+        self.gui.menu_File.insertAction(self.gui.action_Preferences, self.action_proxies)
+        # profile what the ui does, for when it's slow
+        self.action_profile = QtGui.QAction('Profile &Session', self)
+        self.action_profile.setCheckable(True)
+        self.action_profile.setChecked(self.profiler.running())
+        self.action_profile.setEnabled(self.profiler.available())
+        self.gui.menu_File.insertAction(self.gui.action_Preferences, self.action_profile)
+        # setup model, the view goes through a filter that can also sort it
         self.model = ShotgunFileModel(self.stack, self.gui.file_table_view)
-        self.gui.file_table_view.setModel(self.model)
+        self.file_filter = FileFilterModel(self)
+        self.file_filter.setSourceModel(self.model)
+        self.gui.file_table_view.setModel(self.file_filter)
+        # start out in queue order
+        self.gui.file_table_view.horizontalHeader().setSortIndicator(-1, QtCore.Qt.AscendingOrder)
+        self.gui.file_table_view.setSortingEnabled(True)
+        # filter box over the table, applied once typing stops
+        self.filter_edit = QtGui.QLineEdit(self)
+        self.filter_edit.setToolTip('Words in the path, link:NAME, type:TYPE, size>N, size<N')
+        queue_order = QtGui.QPushButton('Queue Order', self)
+        queue_order.setToolTip('Show files in the order they will upload')
+        filter_bar = QtGui.QHBoxLayout()
+        filter_bar.addWidget(QtGui.QLabel('Filter:', self))
+        filter_bar.addWidget(self.filter_edit)
+        filter_bar.addWidget(queue_order)
+        self.gui.verticalLayout.insertLayout(self.gui.verticalLayout.indexOf(self.gui.groupBox_2), filter_bar)
+        self.filter_timer = QtCore.QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DELAY)
+        # link names are looked up through an index, the combo box lists them
+        # all and the completer shows the best matches for what's typed
+        self.link_index = SearchIndex()
+        self.link_names = LinkNameModel(self.link_index, self)
+        self.link_matches = LinkNameModel(self.link_index, self)
+        self.gui.link_name.setModel(self.link_names)
+        # otherwise return picks the first row with the typed name
+        self.gui.link_name.setDuplicatesEnabled(True)
+        completer = QtGui.QCompleter(self.link_matches, self)
+        completer.setCompletionMode(QtGui.QCompleter.UnfilteredPopupCompletion)
+        self.gui.link_name.setCompleter(completer)
+        self.gui.link_name.setValidator(MembershipValidator(self.link_index, self))
+        # (name, id) of the link last picked from the list, names aren't unique
+        # so the id has to come from the row that was picked
+        self.link_choice = None
+        self.project_index = SearchIndex()
+        # background load of link names, only the latest one counts
+        self.link_query = None
+        # dropped files get their links worked out in the background
+        self.link_resolver = LinkResolver(self)
+        # drop number -> (paths with no link, sequences missing frames) so far
+        self.drop_problems = {}
         # connect up signals
         self.connect(self.gui.buttons, QtCore.SIGNAL('accepted()'), self.ok)
         self.connect(self.gui.buttons, QtCore.SIGNAL('rejected()'), self.close_window)
@@ -321,15 +3252,35 @@ class Uploader(QtGui.QMainWindow):
         self.connect(self.gui.action_Quit, QtCore.SIGNAL('activated()'), self.close_window)
         self.connect(self.gui.action_Add_Files, QtCore.SIGNAL('activated()'), self.add_files)
         self.connect(self.gui.action_Delete_Selected, QtCore.SIGNAL('activated()'), self.delete_selected)
+        self.connect(self.action_hero_frame, QtCore.SIGNAL('activated()'), self.choose_hero_frame)
+        self.connect(self.action_bulk_edit, QtCore.SIGNAL('activated()'), self.bulk_edit)
+        self.connect(self.action_profile, QtCore.SIGNAL('toggled(bool)'), self.toggle_profile)
+        self.connect(self.action_sequences, QtCore.SIGNAL('toggled(bool)'), self.group_sequences)
         self.connect(self.gui.file_table_view.selectionModel(), QtCore.SIGNAL('selectionChanged(QItemSelection, QItemSelection)'), self.table_selection_changed)
-        self.connect(self.model, QtCore.SIGNAL('filesAdded(QStringList)'), self.add_files)
+        self.connect(self.model, QtCore.SIGNAL('filesAdded(QStringList, int)'), self.add_files)
+        self.connect(self.model, QtCore.SIGNAL('dropFinished(int)'), self.link_resolver.finish)
+        self.connect(self.link_resolver, QtCore.SIGNAL('linksResolved(PyQt_PyObject, int)'), self.links_resolved)
+        self.connect(self.link_resolver, QtCore.SIGNAL('dropResolved(int)'), self.drop_finished)
         self.connect(self.gui.project, QtCore.SIGNAL('currentIndexChanged(QString)'), self.link_data_changed)
         self.connect(self.gui.link_type, QtCore.SIGNAL('currentIndexChanged(QString)'), self.link_data_changed)
+        self.connect(self.gui.link_name.lineEdit(), QtCore.SIGNAL('textEdited(QString)'), self.link_name_edited)
+        self.connect(self.gui.link_name, QtCore.SIGNAL('activated(int)'), self.link_name_picked)
+        self.connect(completer, QtCore.SIGNAL('activated(QModelIndex)'), self.link_name_picked)
+        self.connect(self.filter_edit, QtCore.SIGNAL('textChanged(QString)'), self.filter_timer, QtCore.SLOT('start()'))
+        self.connect(self.filter_timer, QtCore.SIGNAL('timeout()'), self.apply_filter)
+        self.connect(queue_order, QtCore.SIGNAL('clicked()'), self.queue_order)
         # default action states
         self.gui.action_Delete_Selected.setEnabled(False)
+        self.action_hero_frame.setEnabled(False)
+        self.action_bulk_edit.setEnabled(False)
         # load up prefs
         self.prefs = PrefsDialog()
-        # connect to shotgun
+        # thumbnails for stills get made in the background
+        self.thumbnails = ThumbnailEngine()
+        self.filmstrips = FilmstripCache()
+        # connect to shotgun, sharing keep-alive connections between calls
+        self.pool = ConnectionPool()
+        self.pooled = False
         self.__conn = None
         self.__conn = self.__connect_to_shotgun()
         if not self.__conn:
@@ -340,6 +3291,8 @@ class Uploader(QtGui.QMainWindow):
         settings = QtCore.QSettings('ShotgunSharing', 'uploader')
         self.gui.tags.setText(settings.value("main/tags", DEFAULT_TAGS).toString())
         self.restoreGeometry(settings.value("main/geometry").toByteArray())
+        self.action_proxies.setChecked(settings.value("main/proxies", QtCore.QVariant(DEFAULT_PROXIES)).toBool())
+        self.action_sequences.setChecked(settings.value("main/sequences", QtCore.QVariant(DEFAULT_SEQUENCES)).toBool())
         # restore column widths
         col_widths = [int(w.strip()) for w in str(settings.value("main/col_widths", DEFAULT_COL_WIDTHS).toString()).split(',') if w.strip()]
         for i in xrange(min(len(col_widths), self.model.columnCount())):
@@ -352,18 +3305,17 @@ class Uploader(QtGui.QMainWindow):
         """
         # try to load up the shotgun api
         try:
-            if os.path.isdir(self.prefs.shotgun_api):
-                sys.path.append(self.prefs.shotgun_api)
-            else:
-                sys.path.append(os.path.dirname(self.prefs.shotgun_api))
-            import shotgun_api3_preview as sg
+            sg = load_shotgun_api(self.prefs.shotgun_api)
         except ImportError:
-            sys.path.pop()
             QtGui.QMessageBox.critical(self, self.tr("uploader"),
                 self.tr("shotgun_api3_preview module not found.  Update your Preferences."),
                 QtGui.QMessageBox.Ok)
             return None
         conn = sg.Shotgun(self.prefs.shotgun_url, self.prefs.shotgun_script, self.prefs.shotgun_key)
+        self.pooled = install_connection_pool(conn, self.pool) > 0
+        if not self.pooled:
+            print >> sys.stderr, NO_POOL_WARNING
+            self.statusBar().showMessage(NO_POOL_WARNING)
         # validate connection by seeing if Attachments are accessible
         try:
             # use path_field to validate that is set right, if it is set
@@ -411,7 +3363,9 @@ class Uploader(QtGui.QMainWindow):
                     # name matched default project, select it
                     self.gui.project.setCurrentIndex(self.gui.project.count()-1)
             self.gui.project.setCompleter(completer)
-            self.gui.project.setValidator(QtGui.QRegExpValidator(QtCore.QRegExp('|'.join([p[0] for p in projects]), QtCore.Qt.CaseInsensitive), self))
+            self.project_index.clear()
+            self.project_index.add(projects)
+            self.gui.project.setValidator(MembershipValidator(self.project_index, self))
             # setup link type, populate the completer and combo box
             # TODO: should make sure these are active in the instance
             link_types = ['', 'Asset', 'Scene', 'Sequence', 'Shot', 'Task', 'Project', 'Tool', 'Ticket']
@@ -432,8 +3386,13 @@ class Uploader(QtGui.QMainWindow):
 
     def link_data_changed(self, ignored):
         """respond to an update for project or link type"""
-        # zero out the selected link
-        self.gui.link_name.clear()
+        # zero out the selected link, forgetting about any names still coming in
+        self.cancel_link_query()
+        self.link_choice = None
+        self.link_index.clear()
+        self.link_names.refresh()
+        self.link_matches.refresh()
+        self.gui.link_name.clearEditText()
         project = int(self.gui.project.itemData(self.gui.project.currentIndex()).toInt()[0])
         link_type = str(self.gui.link_type.currentText())
         if not link_type:
@@ -442,43 +3401,122 @@ class Uploader(QtGui.QMainWindow):
         filters = project and [['project', 'is', {'type': 'Project', 'id': project}]] or []
         if link_type in ['Project']:
             filters = []
-        # find possible matches, grabbing values that are useful for generating
-        # a pretty name for the different entity types
-        matches = self.__conn.find(link_type, filters, ['display_name', 'content', 'name', 'code', 'sg_sequence', 'sg_asset_type'])
-        texts = ['']
-        self.gui.link_name.addItem('', 0)
-        if matches and matches[0].has_key('sg_sequence'):
-            # going to need sequences
-            seqs = self.__conn.find('Sequence', filters, ['code'])
-            seq_map = dict([(s['id'], s['code']) for s in seqs])
-        for match in matches:
-            # TODO: make the set of extra info included with a name richer
-            # look for something that has a good name
-            text = match.get('display_name', match.get('content', match.get('name', match.get('code', None))))
-            if text is None:
-                # just in case the entity type has no field we know about as a
-                # useful name
-                break
-            if match.has_key('sg_sequence'):
-                # display the sequence if we've got it
-                text = text + " (%s)" % (match['sg_sequence'] and seq_map[match['sg_sequence']['id']] or 'None')
-            elif match.has_key('sg_asset_type'):
-                # display the asset type if we've got it
-                text = text + " (%s)" % match['sg_asset_type']
-            self.gui.link_name.addItem(text, match['id'])
-            texts.append(text)
-        # And setup the completer
-        completer = QtGui.QCompleter(texts, self)
-        completer.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
-        self.gui.link_name.setCompleter(completer)
-        self.gui.link_name.setValidator(QtGui.QRegExpValidator(QtCore.QRegExp('|'.join(texts), QtCore.Qt.CaseInsensitive), self))
+        # find possible matches in the background, names show up a page at a
+        # time as they come in
+        self.link_index.add([('', 0)])
+        self.link_names.refresh()
+        self.link_query = LinkQueryThread(self.__conn, link_type, filters, self)
+        self.connect(self.link_query, QtCore.SIGNAL('pageLoaded(PyQt_PyObject)'), self.link_page_loaded)
+        self.connect(self.link_query, QtCore.SIGNAL('finished()'), self.link_load_finished)
+        self.statusBar().showMessage('Loading %s names...' % link_type)
+        self.link_query.start()
+
+    def cancel_link_query(self):
+        """stop loading link names, whatever is in flight gets ignored"""
+        if self.link_query is not None:
+            self.link_query.cancel()
+            self.link_query = None
+
+    def link_page_loaded(self, entries):
+        """index a page of link names, the combo box and completer pick them up from there"""
+        if self.sender() is not self.link_query:
+            # left over from a selection that has since changed
+            return
+        self.link_index.add(entries)
+        self.link_names.names_added()
+        self.link_matches.names_added()
+        self.statusBar().showMessage('Loading %s names... %d' % (self.link_query.link_type, len(self.link_index)-1))
+
+    def link_load_finished(self):
+        thread = self.sender()
+        if thread is self.link_query:
+            if thread.failed:
+                self.statusBar().showMessage('Loading %s names failed: %s' % (thread.link_type, thread.failed))
+            else:
+                self.statusBar().showMessage('%d %s names' % (len(self.link_index)-1, thread.link_type))
+            self.link_query = None
+        thread.deleteLater()
+
+    def link_name_edited(self, text):
+        """offer the best matches for what's been typed so far"""
+        self.link_choice = None
+        self.link_matches.set_query(unicode(text))
+
+    def link_name_picked(self, index):
+        """remember the entity behind a name picked from the combo box or the completer"""
+        if not isinstance(index, QtCore.QModelIndex):
+            index = self.link_names.index(index)
+        self.link_choice = (str(index.data(QtCore.Qt.DisplayRole).toString()),
+            index.data(QtCore.Qt.UserRole).toInt()[0])
+
+    def link_id(self, name):
+        """
+        Id of the link named name, 0 if there's no such name and None if more
+        than one entity has it and none was picked from the list.
+        """
+        if self.link_choice is not None and self.link_choice[0] == name:
+            return self.link_choice[1]
+        ids = self.link_index.ids(name)
+        if len(ids) > 1:
+            return None
+        return ids and self.link_index.data[ids[0]] or 0
+
+    def selected_rows(self):
+        """sorted model rows with a selection in them"""
+        rows = self.gui.file_table_view.selectionModel().selectedRows()
+        return sorted([self.file_filter.source_row(index.row()) for index in rows])
+
+    def apply_filter(self):
+        """filter the table by what's in the filter box"""
+        self.file_filter.set_filter(self.filter_edit.text())
+        if self.file_filter.query.empty():
+            self.statusBar().clearMessage()
+        else:
+            self.statusBar().showMessage('Showing %d of %d files' % \
+                (self.file_filter.rowCount(), self.model.rowCount()))
+
+    def queue_order(self):
+        """undo any sorting, back to the order files upload in"""
+        self.gui.file_table_view.horizontalHeader().setSortIndicator(-1, QtCore.Qt.AscendingOrder)
+        self.file_filter.sort(-1)
 
     def delete_selected(self):
         """grab selection and delete it"""
-        rows = dict([(index.row(), None) for index in self.gui.file_table_view.selectedIndexes()]).keys()
-        self.stack.push(DeleteFilesCommand(self.model, rows))
+        self.stack.push(DeleteFilesCommand(self.model, self.selected_rows()))
+
+    def choose_hero_frame(self):
+        """pick the hero frame of the selected movie from a filmstrip"""
+        rows = self.selected_rows()
+        if len(rows) != 1:
+            return
+        f = self.model.files[rows[0]]
+        dialog = FilmstripDialog(self.filmstrips, f.path, f.hero_offset, self)
+        try:
+            if dialog.exec_() == QtGui.QDialog.Accepted and dialog.offset != f.hero_offset:
+                # through the model so it can be undone like any other edit
+                index = self.model.index(rows[0], self.model.column_for('hero_offset'))
+                self.model.setData(index, QtCore.QVariant(dialog.offset), QtCore.Qt.EditRole)
+        finally:
+            dialog.dispose()
+
+    def bulk_edit(self):
+        """apply a value to a column of every selected row, undoable as one step"""
+        rows = self.selected_rows()
+        if not rows:
+            return
+        dialog = BulkEditDialog(self.model, len(rows), self)
+        if dialog.exec_() != QtGui.QDialog.Accepted:
+            return
+        command = BulkEditCommand(self.model, rows, dialog.selected_column(), str(dialog.pattern.text()),
+            'edit %d files' % len(rows))
+        if command.new:
+            self.stack.push(command)
 
-    def add_files(self, fnames=None):
+    def add_files(self, fnames=None, drop=None):
+        """
+        Queue up files, asking which if fnames isn't given.  Batches of a drop
+        come in with its number, and problems get saved up for drop_finished.
+        """
         if fnames is None:
             # pop up the file chooser dialog box if the files weren't passed in
             settings = QtCore.QSettings('ShotgunSharing', 'uploader')
@@ -488,39 +3526,111 @@ class Uploader(QtGui.QMainWindow):
             if fnames:
                 # save the dir of the first file selected
                 settings.setValue("fdialog/dir", os.path.dirname(fnames[0]))
-        if fnames:
-            tags = str(self.gui.tags.text())
-            files = []
-            project = int(self.gui.project.itemData(self.gui.project.currentIndex()).toInt()[0])
-            project_text = str(self.gui.project.currentText())
-            skipped_fnames = []
-            for fname in [str(f) for f in fnames]:
-                if str(self.gui.link_name.currentText()):
-                    # if link_name has been selected, use all the info used to
-                    # get to that entity
-                    link_type = str(self.gui.link_type.currentText())
-                    link_name = str(self.gui.link_name.currentText())
-                    link_id = int(self.gui.link_name.itemData(self.gui.link_name.currentIndex()).toInt()[0])
-                    link = {'type': link_type, 'name': link_name, 'id': link_id, 'project': {'type': 'Project', 'id': project}}
+        if not fnames:
+            return
+        link_name = str(self.gui.link_name.currentText())
+        if link_name:
+            link_id = self.link_id(link_name)
+            if not link_id:
+                # rather than guess which one, or link to nothing
+                if link_id is None:
+                    problem = "More than one %s is named %s.  Pick the one you mean from the list."
                 else:
-                    # otherwise try to figure out the link from the path rules
-                    # in the prefs
-                    link = self.__link_for_file(fname)
-                if link is None:
-                    # didn't have a link, remember that so we can error
-                    skipped_fnames.append(fname)
-                    continue
+                    problem = "There is no %s named %s (or it hasn't loaded yet).  Pick one from the list."
+                QtGui.QMessageBox.warning(self, self.tr("uploader"),
+                    self.tr(problem % (self.gui.link_type.currentText(), link_name)),
+                    QtGui.QMessageBox.Ok)
+                if drop is not None:
+                    self.model.feeder.cancel(drop)
+                return
+            # if link_name has been selected, use all the info used to
+            # get to that entity
+            project = int(self.gui.project.itemData(self.gui.project.currentIndex()).toInt()[0])
+            link = {'type': str(self.gui.link_type.currentText()), 'name': link_name, 'id': link_id,
+                'project': {'type': 'Project', 'id': project}}
+            find = lambda fname: dict(link)
+        else:
+            # otherwise try to figure out the link from the path rules
+            # in the prefs
+            find = self.__link_for_file
+        items = [str(f) for f in fnames]
+        if self.action_sequences.isChecked():
+            items = find_sequences(items)
+        if drop is not None:
+            # shotgun gets asked about links in the background, the files
+            # come back to links_resolved
+            self.link_resolver.resolve(items, drop, find)
+            return
+        links = []
+        for item in items:
+            # sequences get linked by the name of the whole run
+            if isinstance(item, FrameSequence):
+                links.append((item, find(item.pattern)))
+            else:
+                links.append((item, find(item)))
+        self.__add_linked(links)
+
+    def links_resolved(self, links, drop):
+        """files from a batch of a drop are back from the link resolver"""
+        self.link_resolver.done()
+        self.__add_linked(links, drop)
+
+    def __add_linked(self, links, drop=None):
+        """queue up (path or FrameSequence, link) pairs"""
+        skipped_fnames = []
+        sequences = []
+        tags = str(self.gui.tags.text())
+        files = []
+        for (item, link) in links:
+            if isinstance(item, FrameSequence):
+                fname = item.pattern
+            else:
+                fname = item
+            if link is None:
+                # didn't have a link, remember that so we can error
+                skipped_fnames.append(fname)
+                continue
+            if isinstance(item, FrameSequence):
+                f = ShotgunSequence(item, tags, link)
+                if item.missing():
+                    sequences.append(item)
+            else:
                 f = ShotgunFile(str(fname), tags, link)
-                files.append(f)
-            # we've got the file objects we're going to create.  do it
-            self.stack.push(NewFileCommand(self.model, files))
+            files.append(f)
+        # we've got the file objects we're going to create.  do it
+        self.stack.push(NewFileCommand(self.model, files, drop=drop))
+        if drop is not None:
+            # more to come, hold off on resizing and warnings until it's all in
+            problems = self.drop_problems.setdefault(drop, ([], []))
+            problems[0].extend(skipped_fnames)
+            problems[1].extend(sequences)
+            self.statusBar().showMessage('Adding dropped files, %d to go' % self.model.feeder.remaining())
+            return
+        self.__files_added(skipped_fnames, sequences)
+
+    def drop_finished(self, drop):
+        """the last of a drop is in"""
+        self.link_resolver.done()
+        (skipped_fnames, sequences) = self.drop_problems.pop(drop, ([], []))
+        self.statusBar().clearMessage()
+        self.__files_added(skipped_fnames, sequences)
+
+    def __files_added(self, skipped_fnames, sequences):
         for i in xrange(self.model.columnCount()):
             # make sure we can see the data
             self.gui.file_table_view.resizeColumnToContents(i)
         if skipped_fnames:
             # and let people know if we skipped something becuase of no links
+            shown = skipped_fnames[:50]
+            if len(skipped_fnames) > len(shown):
+                shown.append('... and %d more' % (len(skipped_fnames) - len(shown)))
+            QtGui.QMessageBox.warning(self, self.tr("uploader"),
+                self.tr("Couldn't figure out link for:\n%s\n\nPlease select what to link it to." % '\n'.join(shown)),
+                QtGui.QMessageBox.Ok)
+        if sequences:
+            # sequences with holes still get added, but say what is missing
             QtGui.QMessageBox.warning(self, self.tr("uploader"),
-                self.tr("Couldn't figure out link for:\n%s\n\nPlease select what to link it to." % '\n'.join(skipped_fnames)),
+                self.tr("Missing frames in:\n%s" % '\n'.join(['%s: %s' % (s.pattern, s.missing_text()) for s in sequences])),
                 QtGui.QMessageBox.Ok)
 
     # Pattern - find an odd # of $ which doesn't have a $ before it
@@ -571,11 +3681,16 @@ class Uploader(QtGui.QMainWindow):
         return None
 
     def table_selection_changed(self, selected=None, deselected=None):
-        """allow delete selected only when there is a row selected"""
-        columns = self.model.columnCount()
-        rows = len(self.gui.file_table_view.selectedIndexes())/columns
-        any = (rows > 0)
+        """allow delete selected only when there is a row selected, hero frames for a single movie"""
+        rows = self.selected_rows()
+        any = (len(rows) > 0)
         self.gui.action_Delete_Selected.setEnabled(any)
+        self.action_bulk_edit.setEnabled(any)
+        movie = False
+        if len(rows) == 1:
+            mime = mimetypes.guess_type(self.model.files[rows[0]].path)[0]
+            movie = (mime is not None and mime.startswith('video'))
+        self.action_hero_frame.setEnabled(movie)
 
     def do_prefs(self):
         """show the prefs dialog and resync with shotgun"""
@@ -589,7 +3704,16 @@ class Uploader(QtGui.QMainWindow):
 
     def ok(self):
         """make the magic happen"""
-        conn = self.__conn
+        remaining = self.model.feeder.remaining()
+        if remaining or self.link_resolver.pending:
+            # the queue would change under the upload
+            QtGui.QMessageBox.information(self, self.tr("uploader"),
+                self.tr("Still adding dropped files (%d to go).  Upload once they're all in." % remaining),
+                QtGui.QMessageBox.Ok)
+            return
+        if self.spool is not None:
+            return self.__spool_files()
+        sender = FileSender(self.__conn, self.prefs, self.thumbnails, self.filmstrips, self.pool)
         prog = QtGui.QProgressDialog()
         # guess that progress will progress along with bytes uploaded
         maximum = sum([f.size for f in self.model.files])
@@ -597,69 +3721,179 @@ class Uploader(QtGui.QMainWindow):
         prog.setMaximum(maximum)
         prog.setLabelText("%-80s" % "Uploading %d/%d: %s" % (0, nfiles, ''))
         prog.setValue(0)
+        # the ui stays alive during uploads, don't let the queue change under us
+        prog.setWindowModality(QtCore.Qt.ApplicationModal)
         prog.show()
+        estimate = ThroughputEstimator(maximum, nfiles)
+        proxies = None
+        if self.action_proxies.isChecked():
+            try:
+                proxies = ProxyStage(parse_proxy_rules(self.prefs.proxy_rules))
+            except ValueError, e:
+                QtGui.QMessageBox.warning(self, self.tr("uploader"),
+                    self.tr("Couldn't parse proxy rules, sending originals.\n%s" % e),
+                    QtGui.QMessageBox.Ok)
         i = 0
-        while self.model.files:
-            i += 1
-            f = self.model.files[0]
-            # let folks know what we're doing
-            prog.setLabelText("%-80s" % "Uploading %d/%d: %s" % (i, nfiles, f.path))
-            if prog.wasCanceled():
-                break
-            # upload
-            f_id = conn.upload(f.link['type'], f.link['id'], f.path)
-            # update tags, path, and reference for
-            data = {'attachment_reference_links': [self.default_link]}
-            if self.prefs.path_field:
-                data[self.prefs.path_field] = f.path
-            if f.tags:
-                data['tag_list'] = f.tags.split(',')
-            conn.update('Attachment', f_id, data)
-            # do thumbnails for files we can
-            mime = mimetypes.guess_type(f.path)[0]
-            if mime is not None and (mime.startswith('video') or mime.startswith('image')):
-                tmp = tempfile.mktemp('.jpg', 'uploader_')
-                try:
-                    # figure out which command to run
-                    cmd = None
-                    if mime.startswith('image'):
-                        cmd = self.prefs.image_command
-                    elif mime.startswith('video'):
-                        cmd = self.prefs.movie_command
-                    if cmd is not None:
-                        # do the replacements for the command and run it
-                        cmd = cmd.replace('$in', '"%s"'% f.path)
-                        cmd = cmd.replace('$out', '"%s"' % tmp)
-                        cmd = cmd.replace('$offset', '"%s"' % f.hero_offset)
-                        os.system(cmd)
-                        if os.path.exists(tmp):
-                            # it worked, upload the thumbnail
-                            conn.upload_thumbnail('Attachment', f_id, tmp)
-                finally:
-                    # make sure we clean up
-                    if os.path.exists(tmp):
-                        os.remove(tmp)
-            if f.note:
-                # add the note if set
-                conn.create('Note', {'content': f.note, 'note_links': [{'type': 'Attachment', 'id': f_id}], \
-                    'project': f.link.get('project', f.link)})
-            # update progress
-            prog.setValue(prog.value()+f.size)
-            # get rid of the file from the interface
-            self.model.delete_files(0, 1)
-            # allow the gui to update
-            QtGui.QApplication.processEvents()
-        # all done, make sure we're clear
+        try:
+            while self.model.files:
+                i += 1
+                f = self.model.files[0]
+                # keep the thumbnailers and proxy makers working a few files
+                # ahead of the upload
+                for ahead in self.model.files[:THUMBNAIL_LOOKAHEAD]:
+                    if (mimetypes.guess_type(ahead.upload_path)[0] or '').startswith('image'):
+                        self.thumbnails.submit(ahead.upload_path)
+                if proxies is not None:
+                    for ahead in self.model.files[:PROXY_LOOKAHEAD]:
+                        if not (isinstance(ahead, ShotgunSequence) and self.prefs.sequence_command):
+                            proxies.submit(ahead.upload_path)
+                # let folks know what we're doing
+                label = "%-80s" % "Uploading %d/%d: %s" % (i, nfiles, f.path)
+                def show_progress():
+                    prog.setLabelText('%s\n%s' % (label, estimate.status()))
+                show_progress()
+                if prog.wasCanceled():
+                    break
+                started = time.time()
+                estimate.start_file(f.size)
+                (f_id, sent) = sender.send(f, self.default_link, proxies,
+                    lambda func, *args: self.__wait_for(show_progress, func, *args))
+                # count progress in original bytes, that's what is left to do
+                estimate.transferred(f.size, sent)
+                # update progress
+                estimate.file_done(time.time() - started - sent)
+                prog.setValue(prog.value()+f.size)
+                # get rid of the file from the interface
+                self.model.delete_files(0, 1)
+                # allow the gui to update
+                QtGui.QApplication.processEvents()
+        finally:
+            # done or not, don't leave proxy processes and files or storage
+            # connections around
+            if proxies is not None:
+                proxies.close()
+            sender.close()
         prog.setValue(maximum)
         self.stack.clear()
+        self.statusBar().showMessage(self.pool_stats())
+
+    def __spool_files(self):
+        """queue everything up in the spool, then help work through it"""
+        rules = None
+        if self.action_proxies.isChecked():
+            try:
+                parse_proxy_rules(self.prefs.proxy_rules)
+                rules = self.prefs.proxy_rules
+            except ValueError, e:
+                QtGui.QMessageBox.warning(self, self.tr("uploader"),
+                    self.tr("Couldn't parse proxy rules, sending originals.\n%s" % e),
+                    QtGui.QMessageBox.Ok)
+        files = self.model.files[:]
+        if not files:
+            return
+        self.spool.enqueue([{'file': f.to_dict(), 'default_link': self.default_link, 'proxy_rules': rules} \
+            for f in files])
+        # they're someone's job now, spooled files can't be taken back
+        self.model.delete_files(0, len(files))
+        self.stack.clear()
+        prog = QtGui.QProgressDialog()
+        prog.setWindowModality(QtCore.Qt.ApplicationModal)
+        prog.setLabelText("%-80s" % "Spooled %d files" % len(files))
+        prog.show()
+        worker = SpoolWorker(self.spool, FileSender(self.__conn, self.prefs, self.thumbnails, self.filmstrips, self.pool))
+        sent = 0
+        failed = 0
+        try:
+            while not prog.wasCanceled():
+                # other workers may be on the same jobs, so progress is the spool's
+                counts = self.spool.counts()
+                total = sum(counts.values())
+                prog.setMaximum(total)
+                prog.setValue(counts['done'] + counts['failed'])
+                job = worker.claim()
+                if job is None:
+                    break
+                (job_id, f, payload) = job
+                label = "%-80s" % "Sending %s\n%d queued, %d in progress, %d done, %d failed" % \
+                    (f.path, counts['queued'], counts['claimed'], counts['done'], counts['failed'])
+                prog.setLabelText(label)
+                error = worker.work(job_id, f, payload, lambda func, *args: self.__wait_for(lambda: None, func, *args))
+                if error is None:
+                    sent += 1
+                else:
+                    failed += 1
+                QtGui.QApplication.processEvents()
+        finally:
+            worker.close()
+        prog.close()
+        counts = self.spool.counts()
+        self.statusBar().showMessage("Sent %d, %d failed.  Spool has %d queued and %d in progress.  %s" % \
+            (sent, failed, counts['queued'], counts['claimed'], self.pool_stats()))
+
+    def pool_stats(self):
+        """connection reuse for the status bar, saying so if shotgun calls bypass the pool"""
+        if self.pooled:
+            return self.pool.stats()
+        return '%s, Shotgun calls not pooled' % self.pool.stats()
+
+    def __wait_for(self, tick, func, *args):
+        """
+        Call func(*args) in a thread and return what it does, calling tick and
+        keeping the ui responsive while waiting.
+        """
+        result = {}
+        def run():
+            try:
+                result['value'] = func(*args)
+            except:
+                result['error'] = sys.exc_info()
+        thread = threading.Thread(target=run)
+        thread.start()
+        while thread.isAlive():
+            thread.join(0.25)
+            tick()
+            QtGui.QApplication.processEvents()
+        if 'error' in result:
+            raise result['error'][0], result['error'][1], result['error'][2]
+        return result['value']
+
+    def group_sequences(self, on):
+        """collapse numbered frames into sequences as they're added, or don't"""
+        self.model.feeder.sequences = on
+
+    def toggle_profile(self, on):
+        """start profiling into a file, or stop and write it out"""
+        if on and not self.profiler.running():
+            path = str(QtGui.QFileDialog.getSaveFileName(self, 'Save profile to', 'uploader.prof'))
+            if not path or not self.profiler.start(path):
+                self.action_profile.setChecked(False)
+        elif not on and self.profiler.running():
+            self.statusBar().showMessage('Profile written to %s' % self.profiler.stop())
+
+    def ui_stalled(self, stall):
+        """let folks know the stall they just sat through was noticed"""
+        (seconds, stack) = stall
+        self.statusBar().showMessage('Stalled for %.1fs in %s' % (seconds, innermost(stack)))
 
     def close_window(self):
+        # nothing more to load
+        self.cancel_link_query()
+        self.link_resolver.stop()
+        # cancelled link queries finish the page they're on, and filmstrips
+        # handed over from closed dialogs their movie.  a thread destroyed
+        # still running takes the app down with it
+        for thread in self.findChildren(QtCore.QThread):
+            if isinstance(thread, LinkQueryThread):
+                thread.cancel()
+            thread.wait()
         # save state
         settings = QtCore.QSettings('ShotgunSharing', 'uploader')
         settings.setValue("main/tags", QtCore.QVariant(self.gui.tags.text()))
         settings.setValue("main/project", QtCore.QVariant(self.gui.project.currentText()))
         settings.setValue("main/link_type", QtCore.QVariant(self.gui.link_type.currentText()))
         settings.setValue("main/geometry", self.saveGeometry())
+        settings.setValue("main/proxies", QtCore.QVariant(self.action_proxies.isChecked()))
+        settings.setValue("main/sequences", QtCore.QVariant(self.action_sequences.isChecked()))
         col_widths = ','.join([str(self.gui.file_table_view.columnWidth(i)) \
                                 for i in xrange(self.model.columnCount())])
         settings.setValue("main/col_widths", QtCore.QVariant(col_widths))
@@ -993,13 +4227,13 @@ class Ui_Preferences(object):
         self.groupBox.setTitle(QtGui.QApplication.translate("Preferences", "Thumbnail Generation", None, QtGui.QApplication.UnicodeUTF8))
         self.label_2.setText(QtGui.QApplication.translate("Preferences", "Movie Command:", None, QtGui.QApplication.UnicodeUTF8))
         self.label.setText(QtGui.QApplication.translate("Preferences", "Image Command:", None, QtGui.QApplication.UnicodeUTF8))
-        self.movie_command.setText(QtGui.QApplication.translate("Preferences", "ffmpeg -y -i $in -f mjpeg -ss $offset -vframes 1 -s svga -an $out", None, QtGui.QApplication.UnicodeUTF8))
-        self.image_command.setText(QtGui.QApplication.translate("Preferences", "convert $in $out", None, QtGui.QApplication.UnicodeUTF8))
+        self.movie_command.setText(QtGui.QApplication.translate("Preferences", "ffmpeg -v error -i $in -f mjpeg -ss $offset -vframes 1 -s svga -an pipe:1", None, QtGui.QApplication.UnicodeUTF8))
+        self.image_command.setText(QtGui.QApplication.translate("Preferences", "convert $in -thumbnail 800x600 jpeg:-", None, QtGui.QApplication.UnicodeUTF8))
         self.label_8.setText(QtGui.QApplication.translate("Preferences", "<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0//EN\" \"http://www.w3.org/TR/REC-html40/strict.dtd\">\n"
 "<html><head><meta name=\"qrichtext\" content=\"1\" /><style type=\"text/css\">\n"
 "p, li { white-space: pre-wrap; }\n"
 "</style></head><body style=\" font-family:\'Lucida Grande\'; font-size:13pt; font-weight:400; font-style:normal;\">\n"
-"<p style=\" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><span style=\" font-size:9pt;\">The commands to run to generate a thumbnail for a generic image, movie, or photoshop doc respectively.  The string $in will be replaced with the path to the input file.  The string $out will be replaced with the temporary thumbnail file.  The string $offset will be replaced with the offset to the hero frame.</span></p></body></html>", None, QtGui.QApplication.UnicodeUTF8))
+"<p style=\" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><span style=\" font-size:9pt;\">The commands to run to generate a thumbnail for an image or a movie respectively.  The string $in will be replaced with the path to the input file, and $offset with the offset to the hero frame.  The command should write the JPEG thumbnail to stdout, as the defaults do.  A command using $out instead has it replaced with a temporary file, which is read back when the command is done.</span></p></body></html>", None, QtGui.QApplication.UnicodeUTF8))
         self.groupBox_2.setTitle(QtGui.QApplication.translate("Preferences", "Shotgun", None, QtGui.QApplication.UnicodeUTF8))
         self.label_3.setText(QtGui.QApplication.translate("Preferences", "Shotgun URL:", None, QtGui.QApplication.UnicodeUTF8))
         self.shotgun_url.setText(QtGui.QApplication.translate("Preferences", "http://shotgun.kickass-studios.com/", None, QtGui.QApplication.UnicodeUTF8))
@@ -1031,8 +4265,47 @@ class Ui_Preferences(object):
 "<p style=\" margin-top:0px; margin-bottom:0px; margin-left:0px; margin-right:0px; -qt-block-indent:0; text-indent:0px;\"><span style=\" font-size:10pt;\">The values filled out in this table will determine what an uploaded file will be linked to.  The formate is \'Entity Type\': \'Match\'.  Match  is an expression that is run against the full path of the file being uploaded.  Variables starting with \'$\' will be matched against the full path of the file being uploaded.  The name of the variable will be used in a shotgun find_one call to find the entity to link to.  If there are no matches, the file is linked to the Person entity matching the username of the person doing the upload.  These rules are evaluated in order and the first match wins.</span></p></body></html>", None, QtGui.QApplication.UnicodeUTF8))
 
 if __name__ == '__main__':
-    app = QtGui.QApplication(sys.argv)
-    w = Uploader()
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--spool', dest='spool', default=None, metavar='DIR',
+        help='queue uploads in the spool in DIR, shared with other uploaders and workers')
+    parser.add_option('--worker', dest='worker', action='store_true', default=False,
+        help='work through the spool with no window')
+    parser.add_option('--name', dest='name', default=None, help='worker name in spool stats [host:pid]')
+    parser.add_option('--exit-when-empty', dest='exit_when_empty', action='store_true', default=False,
+        help='stop working once the spool is empty')
+    parser.add_option('--stats', dest='stats', action='store_true', default=False,
+        help='print spool and per worker stats and exit')
+    parser.add_option('--profile', dest='profile', default=None, metavar='FILE',
+        help='profile the session with cProfile and write it to FILE on exit')
+    parser.add_option('--stall-threshold', dest='stall_threshold', type='float', default=STALL_THRESHOLD,
+        help='seconds the ui can hang before its stack is logged, 0 to turn off [%default]')
+    parser.add_option('--stall-log', dest='stall_log', default=None, metavar='FILE',
+        help='append stalls to FILE instead of stderr')
+    (qt_args, argv) = split_qt_args(sys.argv)
+    (options, args) = parser.parse_args(argv[1:])
+    if (options.worker or options.stats) and not options.spool:
+        parser.error('--worker and --stats need --spool')
+    if options.spool and json is None:
+        parser.error('--spool needs python 2.6+')
+    if options.stats:
+        print format_spool_stats(Spool(options.spool))
+        sys.exit(0)
+    if options.worker:
+        # settings need an application, but there's nothing to show
+        app = QtCore.QCoreApplication(qt_args)
+        sys.exit(run_worker(options.spool, options.name, options.exit_when_empty))
+    app = QtGui.QApplication(qt_args)
+    profiler = SessionProfiler()
+    if options.profile and not profiler.start(options.profile):
+        parser.error('cProfile is not available')
+    watchdog = StallWatchdog(options.stall_threshold, options.stall_log)
+    watchdog.start()
+    w = Uploader(options.spool and Spool(options.spool), profiler)
+    w.connect(watchdog, QtCore.SIGNAL('stalled(PyQt_PyObject)'), w.ui_stalled)
     w.show()
     w.raise_()
-    sys.exit(app.exec_())
+    status = app.exec_()
+    watchdog.stop()
+    # whatever was being profiled when the window closed
+    profiler.stop()
+    sys.exit(status)